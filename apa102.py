@@ -3,7 +3,10 @@ import math
 import os
 from colorsys import hsv_to_rgb
 import numpy as np
-from spi_background import SpiMaster
+import spidev_sim
+from color import hsv_to_rgb_array
+from frame_scheduler import monotonic
+from spi_background import FrameGroup, SharedMemorySpiMaster, SpiMaster
 
 # TODO DRY spi_background.py
 try:
@@ -20,27 +23,162 @@ gamma = 2.5
 spi_max_speed_hz = 8000000
 pixel_global_brightness = False
 
+# How frames reach the SPI worker process: 'shared_memory' encodes them in place into a shared-memory ring, and
+# drops stale frames if the worker falls behind; 'queue' pickles them through a queue.
+spi_transport = 'shared_memory'
+
+# `send_frame` skips a frame that is identical to the last one it sent, such as a static scene's or a dark strip's,
+# unless this many seconds have passed since then. The refresh repairs pixels that glitched. 0 sends every frame.
+refresh_interval = 1.0
+
+# Pixels are stored as `pixel_dtype`. A float type stores colors as is. uint16 stores them in fixed point, with
+# FIXED_POINT_ONE standing for 1.0, and adding to a pixel saturates at FIXED_POINT_MAX instead of wrapping around.
+pixel_dtype = np.float64
+PIXEL_DTYPES = {'float64': np.float64, 'float32': np.float32, 'uint16': np.uint16}
+
+# The encoder quantizes each clipped component to a LUT_BITS fixed-point index, and looks up its output byte in a
+# table. The bins are narrow enough that the output changes at most once within a bin, so a second table holds the
+# component value at which it changes. This reproduces the floating-point encoding exactly.
+LUT_BITS = 12
+
+# A fixed-point component is a bin index, and needs no threshold table.
+FIXED_POINT_ONE = 1 << LUT_BITS
+FIXED_POINT_MAX = 0xffff
+
+_encoder_tables_cache = {}
+
+
+def _float_thresholds(f, codes):
+    """Return, for each code k in `codes`, the smallest float x in [0, 1] for which f(x) >= k.
+
+    `f` must be monotonic, with f(0) < k <= f(1). The search bisects the bit patterns of the non-negative floats,
+    which sort in the same order as their values.
+    """
+    lo = np.zeros(len(codes), np.int64)
+    hi = np.tile(np.array(1.0).view(np.int64), len(codes))
+    while np.any(hi - lo > 1):
+        mid = (lo + hi) // 2
+        above = f(mid.view(np.float64)) >= codes
+        hi = np.where(above, mid, hi)
+        lo = np.where(above, lo, mid)
+    return hi.view(np.float64)
+
+
+def _encoder_tables(gamma, dtype=np.float64):
+    """Return (byte, brightness) lookup tables for `gamma`, for components of the float type `dtype`.
+
+    Each is a pair (codes, thresholds) indexed by bin: `codes[i]` is the output at the start of bin i, and the output is
+    one greater for components >= `thresholds[i]`.
+    """
+    key = (gamma, np.dtype(dtype).name)
+    tables = _encoder_tables_cache.get(key)
+    if tables:
+        return tables
+    if key[1] != 'float64':
+        # Round each threshold up to `dtype`, so that comparing a `dtype` component with it gives the same answer.
+        tables = []
+        for codes, thresholds in _encoder_tables(gamma):
+            rounded = thresholds.astype(dtype)
+            below = rounded < thresholds
+            rounded[below] = np.nextafter(rounded[below], np.inf)
+            tables.append((codes, rounded))
+        tables = _encoder_tables_cache[key] = tuple(tables)
+        return tables
+
+    bins = np.arange((1 << LUT_BITS) + 1) / float(1 << LUT_BITS)
+
+    def make_table(f):
+        codes = f(bins)
+        assert np.all(np.diff(codes) <= 1), 'LUT_BITS is too small for gamma=%s' % gamma
+        max_code = int(codes[-1])
+        thresholds = np.r_[_float_thresholds(f, np.arange(1, max_code + 1)), np.inf]
+        codes = codes.astype(np.uint8)
+        return codes, thresholds[codes]
+
+    tables = (make_table(lambda x: np.round(255 * x ** gamma)),
+              make_table(lambda x: np.ceil(x ** gamma * 31)))
+    _encoder_tables_cache[key] = tables
+    return tables
+
+
+def is_fixed_point(pixels):
+    return pixels.dtype.kind == 'u'
+
+
+def to_fixed_point(rgbs, out=None, add=None):
+    """Return the float colors `rgbs` in fixed point, rounded and saturated, as uint16. If `add`, fixed-point
+    values, is supplied, the sum is returned."""
+    values = np.multiply(rgbs, FIXED_POINT_ONE)
+    if add is not None:
+        values = values + add
+    # Rounds half up. This is faster than np.rint, which rounds half to even.
+    values += 0.5
+    np.clip(values, 0, FIXED_POINT_MAX, out=values)
+    if out is None:
+        return values.astype(np.uint16)
+    np.copyto(out, values, casting='unsafe')
+    return out
+
 
 class APA102(object):
-    def __init__(self, count, bus=0, device=1, multiprocessing=None):
+    """Drives a strip of APA102 pixels from one SPI device.
+
+    Scenes draw into `leds`, an np.ndarray([count, 3]) of `dtype`, which defaults to `pixel_dtype`. The drawing methods
+    take float colors whatever the dtype; code that writes to `leds` directly should use `set_rgb_array` and
+    `rgb_array`, so that it works with fixed point.
+    """
+    def __init__(self, count, bus=0, device=1, multiprocessing=None, frame_group=None, frame_group_index=0,
+                 simulated=False, dtype=None):
         if multiprocessing is None:
-            multiprocessing = not hasattr(spi_driver, 'SIMULATED')
+            multiprocessing = not simulated and not hasattr(spi_driver, 'SIMULATED')
         self.count = count
         self.spi = None
-        if multiprocessing:
+        if simulated:
+            self.spi = spidev_sim.SPI('/dev/spidev%d.%d' % (bus, device), 0, spi_max_speed_hz)
+        elif multiprocessing and spi_transport == 'shared_memory':
+            self.spi = SharedMemorySpiMaster(frame_size=4 + 4 * count, group=frame_group, index=frame_group_index,
+                                             bus=bus, device=device, max_speed_hz=spi_max_speed_hz)
+        elif multiprocessing:
             self.spi = SpiMaster(bus=bus, device=device, max_speed_hz=spi_max_speed_hz)
         else:
             self.spi = spi_driver.SPI('/dev/spidev%d.%d' % (bus, device), 0, spi_max_speed_hz)
             # self.spi = spi = spidev.SpiDev()
             # spi.open(bus, device)
             # spi.max_speed_hz = spi_max_speed_hz
-        self.leds = np.zeros((self.count, 3))
+        self.dtype = np.dtype(dtype or pixel_dtype)
+        self.leds = np.zeros((self.count, 3), self.dtype)
         self.clear()
 
+        # The frame is a four-byte header of zeros, followed by a (brightness, b, g, r) quad for each pixel.
+        self.frame = np.zeros(4 + 4 * count, np.uint8)
+        self._frame_pixels = self.frame[4:].reshape(count, 4)
+        self._frame_pixels[:, 0] = 0xff
+
+        # the last frame that `send_frame` sent, and when
+        self._sent_frame = np.zeros_like(self.frame)
+        self._sent_time = None
+        self.unchanged_frames = 0
+
+        # scratch buffers for `encode`. Components are compared in float32 if the pixels are float32.
+        float_dtype = np.float32 if self.dtype == np.float32 else np.float64
+        self._components = np.empty((count, 3), float_dtype)
+        if is_fixed_point(self.leds):
+            self._clipped = np.empty((count, 3), self.dtype)
+            self._float_leds = np.empty((count, 3))
+        self._bin_indices = np.empty((count, 3), np.intp)
+        self._codes = np.empty((count, 3), np.uint8)
+        self._thresholds = np.empty((count, 3), float_dtype)
+        self._carry = np.empty((count, 3), bool)
+        self._brightness = np.empty(count, np.uint8)
+        self._scale = np.empty(count)
+        self._brightness_scale = np.r_[0, np.array(255. * 31) / np.arange(1, 32)]
+
     def clear(self):
         self.leds[:, :] = 0.0
 
     def set_rgb(self, x, r, g, b):
+        if is_fixed_point(self.leds):
+            r, g, b = [min(max(int(round(c * FIXED_POINT_ONE)), 0), FIXED_POINT_MAX) for c in (r, g, b)]
         if 0 <= x < self.count:
             # Slower alternatives:
             #   pixel = self.leds[x]; pixel[1] = g; etc. # somewhat slower
@@ -60,12 +198,62 @@ class APA102(object):
             self.add_rgb(x + 1, f * r, f * g, f * b)
             return
         if 0 <= x < self.count:
+            if is_fixed_point(self.leds):
+                self._add(self.leds[x], (r, g, b))
+                return
             # The following is much faster than self.leds[x] += [g, b, r]
             led = self.leds[x]
             led[0] += r
             led[1] += g
             led[2] += b
 
+    def _add(self, pixels, rgbs):
+        """Add the float colors `rgbs` to `pixels`, a view into `self.leds`, saturating if it's fixed point."""
+        if not is_fixed_point(pixels):
+            pixels += rgbs
+            return
+        to_fixed_point(rgbs, out=pixels, add=pixels)
+
+    """ This increments the pixels at positions `xs` by the corresponding colors in `rgbs`.
+
+    Positions that are off the strip are ignored. A float position is anti-aliased across two pixels, as in `add_rgb`.
+    Colors at the same index accumulate.
+
+    Parameters
+    ----------
+    xs : np.ndarray([n]) of ints or floats
+    rgbs : np.ndarray([n, 3]), or a single color that is added at each position
+    """
+    def add_rgb_many(self, xs, rgbs):
+        xs = np.asarray(xs)
+        rgbs = np.broadcast_to(np.asarray(rgbs, dtype=float), (len(xs), 3))
+        if xs.dtype.kind == 'f':
+            f, xs = np.modf(xs)
+            xs = xs.astype(np.intp)
+            xs = np.r_[xs, xs + 1]
+            rgbs = np.r_[rgbs, rgbs] * np.r_[1.0 - f, f][:, np.newaxis]
+        in_bounds = (0 <= xs) & (xs < self.count)
+        xs, rgbs = xs[in_bounds], rgbs[in_bounds]
+        if len(xs) > self.count // 4:
+            # With this many colors, summing them over the whole strip is cheaper than finding their positions.
+            pixels, inverse = slice(None), xs
+            n = self.count
+        else:
+            # Sum the colors at each distinct position, and add the sums to just those pixels.
+            pixels, inverse = np.unique(xs, return_inverse=True)
+            n = len(pixels)
+        sums = np.empty((n, 3))
+        for c in xrange(3):
+            sums[:, c] = np.bincount(inverse, weights=rgbs[:, c], minlength=n)
+        leds = self.leds
+        if is_fixed_point(leds):
+            leds[pixels] = to_fixed_point(sums, add=leds[pixels])
+        else:
+            leds[pixels] += sums
+
+    def add_hsv_many(self, xs, hsvs):
+        self.add_rgb_many(xs, hsv_to_rgb_array(hsvs))
+
     def set_hsv(self, x, h, s, v):
         self.set_rgb(x, *hsv_to_rgb(h, s, v))
 
@@ -73,7 +261,9 @@ class APA102(object):
         self.add_rgb(x, *hsv_to_rgb(h, s, v))
 
     def add_range_rgb(self, x0, x1, r, g, b):
-        self.leds[x0:x1] += [r, g, b]
+        leds = self.leds
+        # A color of the pixels' float type adds faster than one that has to be converted.
+        self._add(leds[x0:x1], np.array([r, g, b], float if is_fixed_point(leds) else leds.dtype))
 
     def add_range_hsv(self, x0, x1, h, s, v):
         self.add_range_rgb(x0, x1, *hsv_to_rgb(h, s, v))
@@ -87,34 +277,218 @@ class APA102(object):
     rgbs : np.ndarray([n, 3])
     """
     def add_rgb_array(self, x0, rgbs):
-        leds = self.leds
-        n = leds.shape[0]
+        x0, x1, rgbs = self._clip_range(x0, rgbs)
+        if x0 < x1:
+            self._add(self.leds[x0:x1], rgbs)
+
+    def set_rgb_array(self, x0, rgbs):
+        """Set the pixels from `x0` on to the float colors in `rgbs`, an np.ndarray([n, 3])."""
+        x0, x1, rgbs = self._clip_range(x0, rgbs)
+        if x0 >= x1:
+            return
+        if is_fixed_point(self.leds):
+            to_fixed_point(rgbs, out=self.leds[x0:x1])
+        else:
+            self.leds[x0:x1] = rgbs
+
+    def _clip_range(self, x0, rgbs):
+        """Return (x0, x1, rgbs), clipped to the pixels that exist."""
+        n = self.leds.shape[0]
         x1 = x0 + rgbs.shape[0]
         if x1 < 0 or n <= x0:
-            return
+            return 0, 0, rgbs
         if x0 < 0:
             rgbs = rgbs[-x0:]
             x0 = 0
         if x1 > n:
             x1 = n
             rgbs = rgbs[:x1 - x0, :]
-        leds[x0:x1] += rgbs
+        return x0, x1, rgbs
 
-    def show(self):
-        components = np.clip(self.leds, 0.0, 1.0) ** gamma
+    def rgb_array(self, out=None):
+        """Return the pixels as float colors. This is `self.leds` itself if it's a float array; otherwise it's a copy,
+        into `out` if that's supplied."""
+        if not is_fixed_point(self.leds):
+            return self.leds
+        return np.multiply(self.leds, 1. / FIXED_POINT_ONE, out=out)
+
+    def scale(self, factor):
+        """Multiply the pixels by `factor`, a number or a color."""
+        np.multiply(self.leds, factor, out=self.leds, casting='unsafe')
+
+    def _lookup(self, table):
+        """Look up the clipped components, which `encode` has binned into `self._bin_indices`, in `table`."""
+        codes, thresholds = table
+        np.take(codes, self._bin_indices, out=self._codes, mode='clip')
+        np.take(thresholds, self._bin_indices, out=self._thresholds, mode='clip')
+        np.greater_equal(self._components, self._thresholds, out=self._carry)
+        np.add(self._codes, self._carry, out=self._codes)
+        return self._codes
+
+    def encode(self, frame=None, leds=None):
+        """Encode `leds` into `frame`, and return it.
+
+        `leds` defaults to `self.leds`. `frame` defaults to `self.frame`; its four header bytes must already be zero.
+        """
+        if leds is None:
+            leds = self.leds
+        if frame is None:
+            frame = self.frame
+            pixels = self._frame_pixels
+        else:
+            pixels = frame[4:].reshape(self.count, 4)
+        byte_table, brightness_table = _encoder_tables(gamma, self._components.dtype)
+        if is_fixed_point(leds) and not pixel_global_brightness:
+            # Each component is at the start of its bin, so the table's code is exact.
+            bins = np.minimum(leds, FIXED_POINT_ONE, out=self._clipped)
+            pixels[:, 3:0:-1] = np.take(byte_table[0], bins, out=self._codes)
+            pixels[:, 0] = 0xff
+            return frame
+        if is_fixed_point(leds):
+            leds = np.multiply(leds, 1. / FIXED_POINT_ONE, out=self._float_leds)
+        components = np.clip(leds, 0.0, 1.0, out=self._components)
+        np.multiply(components, 1 << LUT_BITS, out=self._thresholds)
+        np.copyto(self._bin_indices, self._thresholds, casting='unsafe')
         if pixel_global_brightness:
-            brightness = np.clip(np.ceil(np.amax(components, axis=1) * 31), 1, 31)
-            bytes = np.floor(self.leds * (np.array(255. * 31) / brightness).reshape(-1, 1))
+            brightness = np.amax(self._lookup(brightness_table), axis=1, out=self._brightness)
+            np.maximum(brightness, 1, out=brightness)
+            scale = np.take(self._brightness_scale, brightness, out=self._scale)
+            np.multiply(leds, scale[:, np.newaxis], out=self._thresholds)
+            pixels[:, 3:0:-1] = np.floor(self._thresholds, out=self._thresholds)
+            pixels[:, 0] = brightness
         else:
-            bytes = np.round(255 * components)
-            brightness = 0xff
-        bytes = np.insert(np.fliplr(bytes), 0, brightness, 1)
-        bytes = np.ravel(bytes).astype('uint8')
+            pixels[:, 3:0:-1] = self._lookup(byte_table)
+            pixels[:, 0] = 0xff
+        return frame
+
+    def prepare_frame(self, leds=None):
+        """Encode `leds`, which defaults to `self.leds`, into the buffer that `send_frame` sends."""
+        if isinstance(self.spi, SharedMemorySpiMaster):
+            self.encode(self.spi.frame_buffer(), leds)
+        else:
+            self.encode(leds=leds)
+
+    def load_frame(self, data):
+        """Copy `data`, a frame that `encode` returned earlier, into the buffer that `send_frame` sends. This is a
+        byte copy, in place of `prepare_frame`."""
+        frame = self.spi.frame_buffer() if isinstance(self.spi, SharedMemorySpiMaster) else self.frame
+        frame[:] = np.frombuffer(data, np.uint8)
+
+    def _prepared_frame(self):
+        if isinstance(self.spi, SharedMemorySpiMaster):
+            return self.spi.buffers[self.spi.write_slot]
+        return self.frame
+
+    def frame_is_due(self, now):
+        """Return True if the frame that `prepare_frame` encoded differs from the last frame that was sent, or if that
+        was sent `refresh_interval` or more seconds before `now`."""
+        return (not refresh_interval or self._sent_time is None or now - self._sent_time >= refresh_interval or
+                not np.array_equal(self._prepared_frame(), self._sent_frame))
+
+    def send_frame(self, force=False):
+        """Send the frame that `prepare_frame` encoded. Unless `force`, a frame that isn't due is counted in
+        `unchanged_frames` instead."""
+        now = monotonic()
+        if not force and not self.frame_is_due(now):
+            self.unchanged_frames += 1
+            return
+        frame = self._prepared_frame()
+        np.copyto(self._sent_frame, frame)
+        self._sent_time = now
+        if isinstance(self.spi, SharedMemorySpiMaster):
+            self.spi.commit()
+        else:
+            self.spi.transfer(frame.tobytes())
+
+    def show(self):
+        self.prepare_frame()
+        self.send_frame()
 
-        header = np.array([0, 0, 0, 0], 'uint8')
-        self.spi.transfer(header.tobytes())
-        self.spi.transfer(bytes.tobytes())
+    @property
+    def dropped_frames(self):
+        """The number of frames that the SPI transport dropped because the worker fell behind."""
+        return getattr(self.spi, 'dropped_frames', 0)
 
     def close(self):
         logger.info('close')
         self.spi.close()
+
+
+class SegmentedAPA102(APA102):
+    """A driver for a logical strip whose pixels are split, in order, across several SPI devices.
+
+    Each segment is an APA102 whose `leds` is a view into this driver's `leds`. With the shared-memory transport, each
+    segment has its own SPI worker process; the workers share a FrameGroup, so that they send each frame in parallel
+    and in sync.
+
+    Parameters
+    ----------
+    segments : [(bus, device, count)]
+    dtype : np.dtype
+      The pixel dtype. Defaults to `pixel_dtype`.
+    """
+    def __init__(self, segments, multiprocessing=None, simulated=False, dtype=None):
+        if multiprocessing is None:
+            multiprocessing = not simulated and not hasattr(spi_driver, 'SIMULATED')
+        self.count = count = sum(n for _, _, n in segments)
+        self.dtype = np.dtype(dtype or pixel_dtype)
+        self.leds = np.zeros((count, 3), self.dtype)
+        self.frame_group = None
+        self.unchanged_frames = 0
+        if multiprocessing and spi_transport == 'shared_memory':
+            self.frame_group = FrameGroup([4 + 4 * n for _, _, n in segments])
+
+        self.segments = []
+        self.segment_ranges = []  # [(start_index, 1 + end_index)]
+        x0 = 0
+        for i, (bus, device, n) in enumerate(segments):
+            segment = APA102(n, bus=bus, device=device, multiprocessing=multiprocessing,
+                             frame_group=self.frame_group, frame_group_index=i, simulated=simulated,
+                             dtype=self.dtype)
+            segment.leds = self.leds[x0:x0 + n]
+            self.segments.append(segment)
+            self.segment_ranges.append((x0, x0 + n))
+            x0 += n
+
+    def encode(self):
+        """Encode each segment into its frame, and return the list of frames."""
+        return [segment.encode(leds=self.leds[x0:x1]) for segment, (x0, x1) in zip(self.segments, self.segment_ranges)]
+
+    def prepare_frame(self, leds=None, map=map):
+        """Encode each segment's part of `leds`. `map` can be a thread pool's, to encode the segments in parallel."""
+        if leds is None:
+            leds = self.leds
+        map(lambda (segment, (x0, x1)): segment.prepare_frame(leds[x0:x1]), zip(self.segments, self.segment_ranges))
+
+    def load_frame(self, data):
+        """Copy `data`, the concatenation of each segment's encoded frame, into the segments' buffers."""
+        offset = 0
+        for segment in self.segments:
+            frame_size = 4 + 4 * segment.count
+            segment.load_frame(buffer(data, offset, frame_size))
+            offset += frame_size
+
+    def send_frame(self, force=False):
+        # The workers of a frame group wait for a frame from every segment, so the segments are sent or skipped
+        # together.
+        now = monotonic()
+        if not force and not any(segment.frame_is_due(now) for segment in self.segments):
+            self.unchanged_frames += 1
+            return
+        if not self.frame_group:
+            for segment in self.segments:
+                segment.send_frame(force=True)
+            return
+        # Publish the segments together, so that the workers take them as one frame.
+        with self.frame_group.condition:
+            for segment in self.segments:
+                segment.send_frame(force=True)
+
+    @property
+    def dropped_frames(self):
+        return max(segment.dropped_frames for segment in self.segments)
+
+    def close(self):
+        logger.info('close')
+        for segment in self.segments:
+            segment.close()
@@ -0,0 +1,80 @@
+"""Headless frame benchmarks. Run these via `python lights.py --benchmark`."""
+import timeit
+import numpy as np
+
+STAGES = ['step', 'render', 'encode']
+
+
+def summarize(samples):
+    """Return the p50, p99 and mean of `samples`, which are in seconds, in milliseconds."""
+    ms = 1000 * np.asarray(samples)
+    return dict(p50=np.percentile(ms, 50), p99=np.percentile(ms, 99), mean=np.mean(ms))
+
+
+def time_frames(strip, scene_manager, frames, frame_delta_t, before_frame=None):
+    """Render `frames` frames of `scene_manager`'s scene, with synthetic time and without sleeping.
+
+    `before_frame`, if supplied, is called with the synthetic time before each frame.
+
+    Returns {stage: summary} for each stage in STAGES. The 'encode' stage is `strip.show()`.
+    """
+    timer = timeit.default_timer
+    times = np.zeros((frames, len(STAGES)))
+    for i in xrange(frames):
+        t = i * frame_delta_t
+        if before_frame:
+            before_frame(t)
+        t0 = timer()
+        strip.clear()
+        scene_manager.step(strip, t)
+        t1 = timer()
+        scene_manager.render(strip, t)
+        t2 = timer()
+        strip.show()
+        t3 = timer()
+        times[i] = t1 - t0, t2 - t1, t3 - t2
+    return {stage: summarize(times[:, i]) for i, stage in enumerate(STAGES)}
+
+
+def time_pixel_dtypes(counts=(900, 10000), dtypes=('float64', 'float32', 'uint16'), frames=300):
+    """Time a synthetic frame on a simulated driver for each pixel count and pixel dtype.
+
+    The 'draw' stage clears the pixels, sets them all to a gradient, and adds sparkles and three bands; 'modify' dims
+    them, as the off transition does; 'encode' encodes them.
+
+    Returns {count: {dtype: {stage: summary}}}. Each dtype also has a 'speedup', its mean frame time relative to
+    float64's.
+    """
+    import apa102
+    timer = timeit.default_timer
+    results = {}
+    for count in counts:
+        rng = np.random.RandomState(0)
+        gradient = rng.random_sample((count, 3)) * 0.5
+        sparkles = rng.randint(0, count, count // 100)
+        sparkle_colors = rng.random_sample((len(sparkles), 3))
+        bands = [(i * count // 4, i * count // 4 + count // 10) for i in xrange(3)]
+        results[count] = by_dtype = {}
+        for name in dtypes:
+            driver = apa102.APA102(count, simulated=True, dtype=apa102.PIXEL_DTYPES[name])
+            times = np.zeros((frames, 3))
+            for i in xrange(frames):
+                t0 = timer()
+                driver.clear()
+                driver.set_rgb_array(0, gradient)
+                driver.add_rgb_many(sparkles, sparkle_colors)
+                for x0, x1 in bands:
+                    driver.add_range_rgb(x0, x1, 0.2, 0.1, 0.4)
+                t1 = timer()
+                driver.scale(0.8)
+                t2 = timer()
+                driver.encode()
+                t3 = timer()
+                times[i] = t1 - t0, t2 - t1, t3 - t2
+            driver.close()
+            by_dtype[name] = {stage: summarize(times[:, i]) for i, stage in enumerate(['draw', 'modify', 'encode'])}
+            by_dtype[name]['mean_frame_ms'] = 1000 * np.sum(np.mean(times, axis=0))
+        for name in dtypes:
+            by_dtype[name]['speedup'] = by_dtype['float64']['mean_frame_ms'] / by_dtype[name]['mean_frame_ms'] \
+                if 'float64' in by_dtype else None
+    return results
@@ -0,0 +1,92 @@
+"""Keeps several controllers rendering the same animation time."""
+import numpy as np
+
+
+class ClockSync(object):
+    """Estimates a remote clock, from samples of it that arrive over the network.
+
+    Each sample pairs a reading of the remote clock with the local time at which it arrived. The offset between the
+    clocks drifts linearly, so the estimate is a line fit to the recent offsets. Network delay only ever makes a
+    sample late, so the line is raised to the least-delayed sample, rather than averaged through them.
+
+    Attributes:
+        window (int): Number of recent samples to fit.
+        max_error (float): A sample that is further than this from the estimate, in seconds, restarts the estimate.
+            This happens when the remote clock restarts.
+    """
+
+    def __init__(self, window=60, max_error=1.0):
+        self.window = window
+        self.max_error = max_error
+        self.samples = np.zeros((window, 2))  # (local time, offset), in a ring
+        self.sample_count = 0
+        self.reference_time = None  # local time of the first sample; the fit is relative to this
+        self.intercept = 0.
+        self.slope = 0.
+
+    def add_sample(self, remote_time, local_time):
+        offset = remote_time - local_time
+        if self.sample_count and abs(offset - self.offset(local_time)) > self.max_error:
+            self.sample_count = 0
+        if not self.sample_count:
+            self.reference_time = local_time
+        self.samples[self.sample_count % self.window] = (local_time - self.reference_time, offset)
+        self.sample_count += 1
+
+        samples = self.samples[:min(self.sample_count, self.window)]
+        x, y = samples[:, 0], samples[:, 1]
+        self.slope = np.polyfit(x, y, 1)[0] if len(samples) >= 4 and np.ptp(x) > 0 else 0.
+        self.intercept = np.max(y - self.slope * x)
+
+    def offset(self, local_time):
+        return self.intercept + self.slope * (local_time - self.reference_time)
+
+    def remote_time(self, local_time):
+        """Return the estimated remote clock reading at `local_time`, or None if there are no samples yet."""
+        if not self.sample_count:
+            return None
+        return local_time + self.offset(local_time)
+
+
+class SyncFollower(object):
+    """Follows the scene and animation time that a sync master broadcasts.
+
+    The master's 'sync' messages carry its clock, its frame number at that clock reading, and its animation speed,
+    and animation time at frame `t_frame`. They also carry the name of its scene, the random seed that it renders it
+    with, and the frame number at which the scene started. The master numbers its frames at `fps`
+    frames per second of its clock, so a follower finds the master's frame number from the master's clock, and the
+    frame's animation time from its number, the same way that the master does.
+    """
+
+    def __init__(self):
+        self.clock_sync = ClockSync()
+        self.clock = None
+        self.frame = None
+        self.fps = None
+        self.time = None
+        self.time_frame = None
+        self.speed = 1.0
+        self.scene = None
+        self.seed = None
+        self.start_frame = None
+
+    def update(self, message, local_time):
+        """Record the sync message `message`, which arrived at `local_time`. Return True if the scene or seed
+        changed."""
+        self.clock_sync.add_sample(message['clock'], local_time)
+        self.clock, self.frame, self.fps = message['clock'], message['frame'], message['fps']
+        self.time, self.time_frame, self.speed = message['t'], message['t_frame'], message['speed']
+        self.start_frame = message['start_frame']
+        changed = (message['scene'], message['seed']) != (self.scene, self.seed)
+        self.scene, self.seed = message['scene'], message['seed']
+        return changed
+
+    def frame_number(self, local_time):
+        """Return the number of the master's frame at `local_time`, or None if no sync message has arrived."""
+        if self.frame is None:
+            return None
+        return self.frame + int(round((self.clock_sync.remote_time(local_time) - self.clock) * self.fps))
+
+    def synthetic_time(self, frame_number):
+        """Return the master's animation time at frame `frame_number`."""
+        return self.time + (frame_number - self.time_frame) * (1 / float(self.fps)) * self.speed
@@ -0,0 +1,88 @@
+"""Color conversions on arrays of colors, and palettes of precomputed colors.
+
+For a single color, `colorsys` is faster than these. They pay off when a scene converts many colors per frame, or the
+same few colors every frame: a palette turns the conversion into indexing.
+"""
+import numpy as np
+
+# Number of hues in a hue palette. This is a power of two, so that indices wrap around with a mask.
+PALETTE_SIZE = 1024
+
+# Palettes are memoized by saturation and value, rounded to this many steps.
+PALETTE_STEPS = 256
+
+_palettes = {}
+
+# Indices into (v, q, p, t), in each sector of the hue circle, of the r, g, and b components of an HSV color.
+_HSV_SECTOR_COMPONENTS = np.array([[0, 1, 2, 2, 3, 0], [3, 0, 0, 1, 2, 2], [2, 2, 3, 0, 0, 1]])
+
+
+def hsv_to_rgb_array(hsvs):
+    """Vectorized `colorsys.hsv_to_rgb`.
+
+    Parameters
+    ----------
+    hsvs : np.ndarray([..., 3])
+
+    Returns an array of RGB colors with the same shape.
+    """
+    hsvs = np.asarray(hsvs, dtype=float)
+    h, s, v = hsvs[..., 0], hsvs[..., 1], hsvs[..., 2]
+    i = np.trunc(h * 6.0)
+    f = h * 6.0 - i
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+    sector = i.astype(int) % 6
+    candidates = np.broadcast_arrays(v, q, p, t)
+    rgbs = np.empty(np.broadcast(h, s, v).shape + (3,))
+    for c in xrange(3):
+        rgbs[..., c] = np.choose(_HSV_SECTOR_COMPONENTS[c][sector], candidates)
+    return rgbs
+
+
+def rgb_to_hsv_array(rgbs):
+    """Vectorized `colorsys.rgb_to_hsv`.
+
+    Parameters
+    ----------
+    rgbs : np.ndarray([..., 3])
+
+    Returns an array of HSV colors with the same shape.
+    """
+    rgbs = np.asarray(rgbs, dtype=float)
+    r, g, b = rgbs[..., 0], rgbs[..., 1], rgbs[..., 2]
+    maxc = np.max(rgbs, axis=-1)
+    delta = maxc - np.min(rgbs, axis=-1)
+    gray = delta == 0
+    # Gray colors have a hue and saturation of 0. Divide them by 1 instead, to avoid warnings.
+    safe_delta = np.where(gray, 1, delta)
+    rc, gc, bc = [(maxc - c) / safe_delta for c in (r, g, b)]
+    h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    hsvs = np.empty(rgbs.shape)
+    hsvs[..., 0] = np.where(gray, 0, (h / 6.0) % 1.0)
+    hsvs[..., 1] = np.where(gray, 0, delta / np.where(gray, 1, maxc))
+    hsvs[..., 2] = maxc
+    return hsvs
+
+
+def hue_palette(saturation=1.0, value=1.0):
+    """Return the RGB colors of PALETTE_SIZE evenly spaced hues, at `saturation` and `value`, as an
+    np.ndarray([PALETTE_SIZE, 3]). Index it with `palette_index`.
+
+    The palette is computed once for each saturation and value, to within 1 / PALETTE_STEPS. Don't modify it.
+    """
+    key = (int(round(saturation * PALETTE_STEPS)), int(round(value * PALETTE_STEPS)))
+    palette = _palettes.get(key)
+    if palette is None:
+        hues = np.arange(PALETTE_SIZE) / float(PALETTE_SIZE)
+        palette = hsv_to_rgb_array(np.column_stack((hues, np.tile(key[0], PALETTE_SIZE) / float(PALETTE_STEPS),
+                                                    np.tile(key[1], PALETTE_SIZE) / float(PALETTE_STEPS))))
+        palette.flags.writeable = False
+        _palettes[key] = palette
+    return palette
+
+
+def palette_index(hues):
+    """Return the index of the palette entry nearest to each of `hues`, which wrap around 1.0."""
+    return np.floor(np.multiply(hues, PALETTE_SIZE) + 0.5).astype(int) & (PALETTE_SIZE - 1)
@@ -0,0 +1,100 @@
+"""Blends scenes that are rendered into separate layers."""
+import numpy as np
+
+BLEND_MODES = ('add', 'max', 'alpha', 'multiply')
+
+
+class LayerPool(object):
+    """Preallocated float32 layers of pixels, of shape (count, 3), that are reused from frame to frame."""
+
+    def __init__(self, dtype=np.float32):
+        self.dtype = dtype
+        self.free = {}  # count -> [layer]
+        self.allocated = 0
+
+    def acquire(self, count):
+        """Return a layer of `count` pixels. Its contents are undefined."""
+        free = self.free.get(count)
+        if free:
+            return free.pop()
+        self.allocated += 1
+        return np.zeros((count, 3), self.dtype)
+
+    def release(self, layer):
+        self.free.setdefault(len(layer), []).append(layer)
+
+default_pool = LayerPool()
+
+
+def blend(dest, layer, mode='add', opacity=1.0):
+    """Blend `layer` into `dest` in place, with `mode` and `opacity`. `layer` is used as scratch space.
+
+    Each mode is a sequence of in-place ufuncs, so it allocates nothing:
+
+    - add: dest + opacity * layer
+    - max: max(dest, opacity * layer)
+    - alpha: dest + opacity * (layer - dest), which cross-fades from dest to layer
+    - multiply: dest * (1 - opacity + opacity * layer)
+    """
+    if mode == 'alpha':
+        np.subtract(layer, dest, out=layer)
+        np.multiply(layer, opacity, out=layer)
+        np.add(dest, layer, out=dest)
+        return
+    if opacity != 1:
+        np.multiply(layer, opacity, out=layer)
+    if mode == 'add':
+        np.add(dest, layer, out=dest)
+    elif mode == 'max':
+        np.maximum(dest, layer, out=dest)
+    elif mode == 'multiply':
+        if opacity != 1:
+            np.add(layer, 1 - opacity, out=layer)
+        np.multiply(dest, layer, out=dest)
+    else:
+        raise ValueError('unknown blend mode: %s' % mode)
+
+
+class Compositor(object):
+    """Renders scenes into layers from a LayerPool, and blends them into the strip's pixels.
+
+    A scene renders into a layer while the layer is installed as `strip.driver.leds`, so scenes don't need to know
+    about layers.
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool or default_pool
+
+    def render_layer(self, scene, strip, t):
+        """Render `scene` into a cleared layer, and return the layer. The caller releases it to `self.pool`."""
+        driver = strip.driver
+        layer = self.pool.acquire(len(driver.leds))
+        layer.fill(0)
+        leds, driver.leds = driver.leds, layer
+        try:
+            scene.render(strip, t)
+        finally:
+            driver.leds = leds
+        return layer
+
+    def composite(self, strip, t, layers):
+        """Render each (scene, mode, opacity) of `layers`, in order, and blend it into `strip.driver.leds`.
+
+        A scene whose mode is 'add' at full opacity is rendered straight into the pixels beneath it. For a scene that
+        adds to the pixels, as the sprites do, that is the same as blending its layer, without the layer.
+        """
+        driver = strip.driver
+        for scene, mode, opacity in layers:
+            if mode == 'add' and opacity == 1:
+                scene.render(strip, t)
+                continue
+            layer = self.render_layer(scene, strip, t)
+            if driver.leds.dtype.kind == 'f':
+                blend(driver.leds, layer, mode, opacity)
+            else:
+                # Blend fixed-point pixels as floats.
+                dest = driver.rgb_array(out=self.pool.acquire(len(layer)))
+                blend(dest, layer, mode, opacity)
+                driver.set_rgb_array(0, dest)
+                self.pool.release(dest)
+            self.pool.release(layer)
@@ -0,0 +1,161 @@
+"""Scenes that are pre-rendered to files of encoded APA102 frames, for playback without rendering or encoding.
+
+A cache file is a header, the size of each segment's frame, and then the frames. Each frame is the concatenation of
+the frames that the driver's segments send, as `encode` produces them. The frames all have the same size, so frame i
+is at `data_offset + i * frame_size`.
+"""
+import glob
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import numpy as np
+import apa102
+from led_geometry import COMPILED_GEOMETRY_VERSION, GEOMETRY_HASH
+
+logger = logging.getLogger('frame_cache')
+
+MAGIC = 'XLFC'
+VERSION = 1
+SUFFIX = '.frames'
+
+# magic, version, frame count, frame size, frames per second, segment count
+HEADER = struct.Struct('<4sBxxxIIdI')
+
+
+def scene_parameters(scene):
+    """Return the class and scalar attributes of `scene`, and of its children, as a dict.
+
+    The children of a scene that composites them with blend modes are listed in order, with their modes and opacities.
+    """
+    parameters = {name: value for name, value in vars(scene).items()
+                  if isinstance(value, (bool, int, long, float, basestring))}
+    parameters['class'] = scene.__class__.__name__
+    if hasattr(scene, 'children'):
+        children = [json.dumps(scene_parameters(child), sort_keys=True) for child in scene.children]
+        if hasattr(scene, 'blend_modes'):
+            parameters['children'] = zip(children, scene.blend_modes, scene.opacities)
+        else:
+            parameters['children'] = sorted(children)
+    return parameters
+
+
+def cache_key(name, scene, fps):
+    """Return the key of the frames of `scene`, the scene that `name` creates, rendered at `fps`.
+
+    The key changes with the scene's parameters, the geometry, and the encoder settings.
+    """
+    description = dict(version=VERSION, scene=name, parameters=scene_parameters(scene), fps=fps,
+                       geometry=GEOMETRY_HASH, geometry_version=COMPILED_GEOMETRY_VERSION, gamma=apa102.gamma,
+                       pixel_global_brightness=apa102.pixel_global_brightness,
+                       pixel_dtype=np.dtype(apa102.pixel_dtype).name)
+    return '%s-%s' % (name, hashlib.sha1(json.dumps(description, sort_keys=True)).hexdigest()[:16])
+
+
+def render(strip, scene, path, duration, fps):
+    """Render `duration` seconds of `scene` at `fps`, and write the encoded frames to `path`."""
+    driver = strip.driver
+    frame_sizes = [4 + 4 * segment.count for segment in getattr(driver, 'segments', [driver])]
+    frame_count = max(1, int(round(duration * fps)))
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, frame_count, sum(frame_sizes), fps, len(frame_sizes)))
+        f.write(struct.pack('<%dI' % len(frame_sizes), *frame_sizes))
+        for i in xrange(frame_count):
+            t = i / float(fps)
+            strip.clear()
+            scene.step(strip, t)
+            scene.render(strip, t)
+            frames = driver.encode()
+            for frame in frames if isinstance(frames, list) else [frames]:
+                f.write(frame.tobytes())
+
+
+class CachedFrames(object):
+    """The frames in a cache file, memory-mapped.
+
+    Attributes:
+        frame_count (int): Number of frames.
+        frame_size (int): Size of each frame, in bytes.
+        fps (float): The frame rate that the frames were rendered at.
+        segment_frame_sizes ([int]): Size of each segment's part of a frame, in bytes.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mmap) < HEADER.size:
+            raise ValueError('%s: not a frame cache file' % path)
+        magic, version, self.frame_count, self.frame_size, self.fps, segment_count = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s: not a frame cache file' % path)
+        self.segment_frame_sizes = struct.unpack_from('<%dI' % segment_count, self.mmap, HEADER.size)
+        self.data_offset = HEADER.size + 4 * segment_count
+        if len(self.mmap) != self.data_offset + self.frame_count * self.frame_size:
+            raise ValueError('%s: truncated frame cache file' % path)
+
+    def frame(self, t):
+        """Return the frame for time `t`, as a buffer into the file. Playback loops after the last frame."""
+        i = int(round(t * self.fps)) % self.frame_count
+        return buffer(self.mmap, self.data_offset + i * self.frame_size, self.frame_size)
+
+    def close(self):
+        self.mmap.close()
+
+
+class FrameCache(object):
+    """A directory of cache files.
+
+    When the files take more than `max_bytes`, the least recently used are removed. `get` marks a file as used by
+    updating its modification time.
+    """
+
+    def __init__(self, directory, max_bytes=256 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.open_frames = {}  # key -> CachedFrames
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, key):
+        """Return the CachedFrames for `key`, or None if there aren't any."""
+        if key in self.open_frames:
+            return self.open_frames[key]
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            frames = CachedFrames(path)
+        except (EnvironmentError, ValueError) as err:
+            logger.warning('%s', err)
+            return None
+        os.utime(path, None)
+        self.open_frames[key] = frames
+        return frames
+
+    def put(self, key, strip, scene, duration, fps):
+        """Render `scene` into the cache file for `key`, and return the file's path."""
+        path = self.path(key)
+        temp_path = path + '.tmp'
+        render(strip, scene, temp_path, duration, fps)
+        os.rename(temp_path, path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """Remove the least recently used files, other than `keep`, until the files take at most `max_bytes`."""
+        files = sorted((os.path.getmtime(path), os.path.getsize(path), path)
+                       for path in glob.glob(os.path.join(self.directory, '*' + SUFFIX)))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            logger.info('evict %s', path)
+            os.remove(path)
+            total -= size
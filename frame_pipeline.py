@@ -0,0 +1,79 @@
+"""Overlaps rendering with encoding and sending."""
+import threading
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+import numpy as np
+
+
+class FramePipeline(object):
+    """Encodes and presents frame N on a background thread, while the caller renders frame N+1.
+
+    The pipeline owns two `leds` arrays, and installs one of them as `driver.leds`. `submit` passes the frame that was
+    just rendered to the pipeline thread, and installs the other array for the next frame once the pipeline thread has
+    finished with it. The pipeline thread encodes the frame and calls `present`, which is expected to wait for the
+    frame's deadline and send it.
+
+    numpy releases the global interpreter lock in its array loops, so the two threads can use two cores.
+
+    Parameters
+    ----------
+    driver : APA102 or SegmentedAPA102
+    present : function
+      Called on the pipeline thread, with `profiler`, after each frame is encoded.
+    threads : int
+      If greater than one, and the driver has several segments, the segments are encoded in parallel on a pool of this
+      many threads.
+    profiler : FrameProfiler
+      If supplied, records the pipeline thread's stages.
+    """
+
+    def __init__(self, driver, present, threads=1, profiler=None):
+        self.driver = driver
+        self.present = present
+        self.profiler = profiler
+        self.pool = ThreadPool(threads) if threads > 1 and hasattr(driver, 'segments') else None
+        self.pending = Queue(1)  # rendered arrays, waiting to be encoded
+        self.free = Queue(1)  # arrays that are available to render into
+        self.free.put(np.zeros_like(driver.leds))
+        self.thread = thread = threading.Thread(name='frame-pipeline', target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, frame=None):
+        """Pass the frame in `driver.leds` to the pipeline, and install an array to render the next frame into.
+
+        If `frame`, an already-encoded frame, is supplied, the pipeline sends it instead of encoding `driver.leds`.
+        """
+        leds = self.free.get()
+        self.pending.put((self.driver.leds, frame))
+        self.driver.leds = leds
+
+    def _run(self):
+        driver = self.driver
+        profiler = self.profiler
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            leds, frame = item
+            if profiler:
+                profiler.start_frame()
+            if frame is not None:
+                driver.load_frame(frame)
+            elif self.pool:
+                driver.prepare_frame(leds, map=self.pool.map)
+            else:
+                driver.prepare_frame(leds)
+            if profiler:
+                profiler.mark('encode')
+            self.present(profiler)
+            self.free.put(leds)
+            if profiler:
+                profiler.end_frame()
+
+    def close(self):
+        """Present the frames that have been submitted, and stop the pipeline thread."""
+        self.pending.put(None)
+        self.thread.join()
+        if self.pool:
+            self.pool.close()
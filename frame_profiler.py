@@ -0,0 +1,125 @@
+"""Per-stage frame timing, kept in a fixed-size ring buffer."""
+import json
+import signal
+import sys
+import time
+import timeit
+import numpy as np
+from benchmark import summarize
+
+# Histogram bin edges, in milliseconds.
+HISTOGRAM_BINS_MS = [0, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16.7, 33.3, 100, float('inf')]
+
+# Stages that wait, for a deadline or for the pipeline thread, rather than work. They don't count towards a frame's
+# budget.
+IDLE_STAGES = frozenset(['sleep', 'submit'])
+
+
+class FrameProfiler(object):
+    """Records the time that each stage of each frame takes.
+
+    Call `start_frame` at the start of each frame, `mark(stage)` at the end of each stage, and `end_frame` at the end
+    of the frame. A stage's time is the time since the previous mark. The profiler keeps the last `capacity` frames.
+
+    Attributes:
+        name (str): Identifies the profiler's reports.
+        budget (float): Frame budget, in seconds. A frame whose working stages take longer is counted as late.
+        late_frames (int): Number of frames that exceeded the budget.
+        dropped_frames (int): Number of frames that weren't displayed. This is maintained by the caller.
+        unchanged_frames (int): Number of frames that weren't sent because they were identical to the previous one.
+            This is maintained by the caller.
+        dump_path (str): File that `dump` appends reports to. If None, reports are written to stderr.
+        dump_interval (float): If set, `end_frame` dumps a report this often, in seconds.
+        subprofilers ([FrameProfiler]): Profilers, for example of other threads, that `dump` also dumps.
+    """
+
+    def __init__(self, capacity=600, budget=1.0 / 60, name='frame'):
+        self.name = name
+        self.capacity = capacity
+        self.budget = budget
+        self.stages = []  # stage names, in order of first appearance
+        self.stage_columns = {}  # stage name -> column in `times`
+        self.times = np.zeros((capacity, 8))  # times[frame % capacity, column] = seconds
+        self.intervals = np.zeros(capacity)  # intervals[frame % capacity] = seconds from this frame to the next
+        self.frame_count = 0
+        self.late_frames = 0
+        self.dropped_frames = 0
+        self.unchanged_frames = 0
+        self.dump_path = None
+        self.dump_interval = None
+        self.subprofilers = []
+        self._timer = timeit.default_timer
+        self._frame_start = None
+        self._last_mark = self._last_dump = self._timer()
+        self._row = self.times[0]
+
+    def start_frame(self):
+        now = self._timer()
+        if self._frame_start is not None:
+            self.intervals[(self.frame_count - 1) % self.capacity] = now - self._frame_start
+        self._frame_start = self._last_mark = now
+        self._row = self.times[self.frame_count % self.capacity]
+        self._row[:] = 0
+
+    def mark(self, stage):
+        now = self._timer()
+        column = self.stage_columns.get(stage)
+        if column is None:
+            column = self._add_stage(stage)
+        self._row[column] += now - self._last_mark
+        self._last_mark = now
+
+    def end_frame(self):
+        row = self._row
+        busy = sum(row[self.stage_columns[stage]] for stage in self.stages if stage not in IDLE_STAGES)
+        if busy > self.budget:
+            self.late_frames += 1
+        self.frame_count += 1
+        if self.dump_interval and self._last_mark - self._last_dump >= self.dump_interval:
+            self.dump()
+
+    def _add_stage(self, stage):
+        column = len(self.stages)
+        if column == self.times.shape[1]:
+            self.times = np.hstack((self.times, np.zeros_like(self.times)))
+            self._row = self.times[self.frame_count % self.capacity]
+        self.stages.append(stage)
+        self.stage_columns[stage] = column
+        return column
+
+    def fps(self):
+        """Return the average frame rate over the recorded frames."""
+        intervals = self.intervals[:min(self.frame_count - 1, self.capacity)]
+        return 1 / np.mean(intervals) if len(intervals) and np.all(intervals > 0) else 0.
+
+    def report(self):
+        """Return a dict of counters, and the timing summary and histogram of each stage."""
+        frames = min(self.frame_count, self.capacity)
+        stages = {}
+        for stage in self.stages:
+            samples = self.times[:frames, self.stage_columns[stage]]
+            summary = summarize(samples)
+            summary['max'] = 1000 * np.max(samples)
+            summary['histogram'] = np.histogram(1000 * samples, HISTOGRAM_BINS_MS)[0].tolist()
+            stages[stage] = summary
+        return dict(profiler=self.name, time=time.time(), frames=self.frame_count, late_frames=self.late_frames,
+                    dropped_frames=self.dropped_frames, unchanged_frames=self.unchanged_frames, fps=self.fps(),
+                    histogram_bins_ms=HISTOGRAM_BINS_MS[:-1], stages=stages)
+
+    def dump(self, *_):
+        """Write a report, as a line of JSON, to `dump_path`. This can be used as a signal handler."""
+        self._last_dump = self._timer()
+        if self.frame_count:
+            line = json.dumps(self.report(), sort_keys=True)
+            if self.dump_path:
+                with open(self.dump_path, 'a') as f:
+                    f.write(line + '\n')
+            else:
+                print >> sys.stderr, line
+        for profiler in self.subprofilers:
+            profiler.dump_path = self.dump_path
+            profiler.dump()
+
+    def install_signal_handler(self, signum=signal.SIGUSR1):
+        """Dump a report whenever the process receives `signum`."""
+        signal.signal(signum, self.dump)
@@ -0,0 +1,82 @@
+"""Paces frames to absolute deadlines."""
+import ctypes
+import ctypes.util
+import time
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock. Use clock_gettime(CLOCK_MONOTONIC) where it's available.
+    class _Timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1  # Linux
+    try:
+        _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c')).clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    except (AttributeError, OSError, TypeError):
+        _clock_gettime = None
+
+    def monotonic():
+        ts = _Timespec()
+        if _clock_gettime is None or _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            return time.time()
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+class FrameScheduler(object):
+    """Schedules frames at fixed intervals of a monotonic clock.
+
+    Each frame has an absolute deadline, at which `wait` returns, and the next frame's deadline is one frame period
+    later, however long the frame took. This keeps the frame rate from drifting.
+
+    A frame that finishes after the following frame's deadline has overrun. By default, the next frame is then due
+    immediately. With `frame_skip`, the deadlines that were missed are skipped, and `advance` reports them so that
+    the caller can advance its animation time by the elapsed wall-clock time.
+
+    Attributes:
+        fps (float): Target frame rate.
+        frame_skip (bool): Skip the deadlines of frames that weren't rendered in time.
+        skipped_frames (int): Number of frame deadlines that have been skipped.
+    """
+
+    def __init__(self, fps=60, frame_skip=False, clock=monotonic):
+        self.fps = float(fps)
+        self.frame_skip = frame_skip
+        self.skipped_frames = 0
+        self.clock = clock
+        self.deadline = None
+
+    @property
+    def frame_delta_t(self):
+        return 1 / self.fps
+
+    def wait(self):
+        """Sleep until the current frame's deadline. Return how late the frame is, in seconds, or 0."""
+        now = self.clock()
+        if self.deadline is None:
+            self.deadline = now
+        delay = self.deadline - now
+        if delay > 0:
+            time.sleep(delay)
+            return 0
+        return -delay
+
+    def advance(self):
+        """Move to the next frame's deadline. Return the number of frame periods that this frame took: 1, plus the
+        number of frames that were skipped."""
+        now = self.clock()
+        frame_delta_t = self.frame_delta_t
+        if self.deadline is None:
+            self.deadline = now
+        self.deadline = min(self.deadline + frame_delta_t, now + frame_delta_t)
+        periods = 1
+        if self.deadline < now:
+            if self.frame_skip:
+                skipped = 1 + int((now - self.deadline) / frame_delta_t)
+                self.deadline += skipped * frame_delta_t
+                self.skipped_frames += skipped
+                periods += skipped
+            else:
+                self.deadline = now
+        return periods
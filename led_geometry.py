@@ -1,8 +1,12 @@
 # from functools import lru_cache
-from math import pi
+import hashlib
+import logging
+import os
+import zipfile
 import numpy as np
 import apa102
 import yaml
+from spatial_index import SpatialIndex
 
 
 # source: http://code.activestate.com/recipes/578231-probably-the-fastest-memoization-decorator-in-the-/
@@ -17,54 +21,217 @@ def memoize(f):
     return MemoDict().__getitem__
 
 with open('geometry.yaml') as f:
-    CONFIG = yaml.safe_load(f)
+    GEOMETRY_YAML = f.read()
+CONFIG = yaml.safe_load(GEOMETRY_YAML)
+
+
+def _geometry_hash():
+    digest = hashlib.sha1(GEOMETRY_YAML)
+    for source in CONFIG.get('points') or []:
+        with open(source['file'], 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+# Identifies the geometry, including the point cloud files that geometry.yaml names, in the keys of caches of data that
+# depend on it.
+GEOMETRY_HASH = _geometry_hash()
+
+logger = logging.getLogger('led_geometry')
+
+# The compiled geometry is saved here, and reused until geometry.yaml changes.
+COMPILED_GEOMETRY_PATH = 'geometry.npz'
+
+# Change this when `compile_geometry` changes, so that previously compiled geometry is recompiled.
+COMPILED_GEOMETRY_VERSION = 2
+
+
+def indices_near_angle(angles, angle):
+    """Return the indices at which `angles`, a pixel's angle as a function of its index, is a local minimum distance from
+    `angle`."""
+    # FIXME misses the endpoints
+    distances = np.abs((angles - angle) % 360)
+    return 1 + (np.diff(np.sign(np.diff(distances))) > 0).nonzero()[0]
+
+
+def read_points(path):
+    """Return the points in `path`, as an np.ndarray([count, 3]).
+
+    A .npy file holds an array of (x, y, z) rows. Any other file is CSV, with x, y and z in the first three columns, an
+    optional header line, and optional '#' comment lines.
+    """
+    if path.endswith('.npy'):
+        points = np.load(path)
+    else:
+        with open(path) as f:
+            lines = [line for line in f if line.strip() and not line.lstrip().startswith('#')]
+        try:
+            float(lines[0].split(',')[0])
+        except (IndexError, ValueError):
+            lines = lines[1:]
+        points = np.loadtxt(lines, delimiter=',', usecols=(0, 1, 2), ndmin=2)
+    if points.ndim != 2 or points.shape[1] != 3:
+        raise Exception('%s: expected (x, y, z) points, not an array of shape %s' % (path, points.shape))
+    return points
+
+
+def transform_points(points, scale=1, rotate=(0, 0, 0), translate=(0, 0, 0)):
+    """Scale `points`, rotate them by `rotate` degrees about the x, then the y, then the z axis, and translate
+    them. `scale` can be a number or an (x, y, z) triple."""
+    rx, ry, rz = np.radians(rotate)
+    rotation = np.dot(np.dot(
+        [[np.cos(rz), -np.sin(rz), 0], [np.sin(rz), np.cos(rz), 0], [0, 0, 1]],
+        [[np.cos(ry), 0, np.sin(ry)], [0, 1, 0], [-np.sin(ry), 0, np.cos(ry)]]),
+        [[1, 0, 0], [0, np.cos(rx), -np.sin(rx)], [0, np.sin(rx), np.cos(rx)]])
+    return np.dot(points * np.asarray(scale, float), rotation.T) + translate
+
+
+def _spiral_geometry(config):
+    """Return (angle, radius, pos) of a spiral, whose angles are interpolated from `config['pixels']['angles']`."""
+    count = config['pixels']['count']
+
+    angle_samples = np.array(sorted((x, a) for a, xs in config['pixels']['angles'].items() for x in xs))
+    # Assume samples are monotonically increasing. Whenever two consecutive samples violate this, add another wind.
+    for i in np.nditer(np.where(np.diff(angle_samples[:, 1]) <= 0)):
+        angle_samples[i + 1:, 1] += 360
+    angle = np.interp(np.arange(count), angle_samples[:, 0], angle_samples[:, 1]) % 360
+
+    radius = np.linspace(1, 0, num=count, endpoint=False)
+
+    angles_r = np.radians(angle)
+    pos = np.c_[
+        0.5 + 0.5 * np.column_stack((radius * np.cos(angles_r), radius * np.sin(angles_r))),
+        np.linspace(1, 0, num=count, endpoint=False)
+    ]
+    return angle, radius, pos
+
+
+def _point_cloud_geometry(sources):
+    """Return (angle, radius, pos, world_pos) of the pixels in the point cloud files of `sources`, the `points` entry
+    of geometry.yaml.
+
+    `pos` is `world_pos` fitted to the unit cube, as the spiral's is: the vertical axis through the middle of the
+    bounding box is at x = y = 0.5, the furthest pixel from it is at radius 1, and z goes from 0 at the bottom to 1 at
+    the top.
+    """
+    clouds = []
+    for source in sources:
+        points = transform_points(read_points(source['file']), source.get('scale', 1),
+                                  source.get('rotate', (0, 0, 0)), source.get('translate', (0, 0, 0)))
+        clouds.append(points[::-1] if source.get('reverse') else points)
+    world_pos = np.concatenate(clouds)
+
+    lo, hi = world_pos.min(axis=0), world_pos.max(axis=0)
+    offsets = world_pos[:, :2] - (lo[:2] + hi[:2]) / 2
+    distances = np.hypot(offsets[:, 0], offsets[:, 1])
+    scale = 0.5 / max(np.max(distances), 1e-9)
+    radius = 2 * scale * distances
+    angle = np.degrees(np.arctan2(offsets[:, 1], offsets[:, 0])) % 360
+    pos = np.column_stack((0.5 + scale * offsets, (world_pos[:, 2] - lo[2]) / max(hi[2] - lo[2], 1e-9)))
+    return angle, radius, pos, world_pos
+
+
+def compile_geometry(config):
+    """Return a dict of the per-pixel and per-ring arrays that `config`, the contents of geometry.yaml, determines.
+
+    Per pixel: `angle` around the vertical axis in degrees, `radius` from that axis, `pos` (x, y, z) in the unit cube,
+    `world_pos` (x, y, z) in the point cloud's units, and `pixel_ring`, the pixel's ring number. Per ring:
+    `ring_radius`, the average radius of the ring's pixels, and `ring_starts` and `ring_ends`. A ring's pixels are
+    `ring_starts[ring]` up to but not including `ring_ends[ring]`.
+
+    Pixel positions come from the point cloud files that `config['points']` lists, if there are any; otherwise from a
+    spiral. The coordinates are float32.
+    """
+    if config.get('points'):
+        angle, radius, pos, world_pos = _point_cloud_geometry(config['points'])
+        expected_count = config.get('pixels', {}).get('count')
+        if expected_count is not None and expected_count != len(pos):
+            raise Exception('geometry.yaml: the point clouds have %d points, not %d' % (len(pos), expected_count))
+    else:
+        angle, radius, pos = _spiral_geometry(config)
+        world_pos = pos
+    angle, radius, pos, world_pos = (a.astype(np.float32) for a in (angle, radius, pos, world_pos))
+    count = len(pos)
+
+    # A new ring starts at each pixel that faces the back. Rings are therefore runs of consecutive pixels.
+    ring_start_flags = np.zeros(count, int)
+    ring_start_flags[[index for index in indices_near_angle(angle, 180) if index > 0]] = 1
+    pixel_ring = np.cumsum(ring_start_flags)
+    ring_sizes = np.bincount(pixel_ring)
+    ring_ends = np.cumsum(ring_sizes)
+
+    return dict(angle=angle, radius=radius, pos=pos, world_pos=world_pos, pixel_ring=pixel_ring,
+                ring_radius=(np.bincount(pixel_ring, weights=radius) / ring_sizes).astype(np.float32),
+                ring_starts=ring_ends - ring_sizes, ring_ends=ring_ends)
+
+
+def load_geometry(path=COMPILED_GEOMETRY_PATH):
+    """Return the compiled geometry, as `compile_geometry` does.
+
+    This reads it from `path` if it was compiled from the current geometry.yaml by the current version of
+    `compile_geometry`. Otherwise it compiles the geometry, and saves it to `path` for next time.
+    """
+    try:
+        with np.load(path) as data:
+            if data['version'] == COMPILED_GEOMETRY_VERSION and data['geometry_hash'] == GEOMETRY_HASH:
+                return {name: data[name] for name in data.files if name not in ('version', 'geometry_hash')}
+    except (EnvironmentError, KeyError, ValueError):
+        pass
+    except zipfile.BadZipfile as err:
+        # for example, if power was cut while the file was being written
+        logger.warning('recompiling the geometry, since %s is corrupt: %s', path, err)
+    geometry = compile_geometry(CONFIG)
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            np.savez(f, version=COMPILED_GEOMETRY_VERSION, geometry_hash=GEOMETRY_HASH, **geometry)
+        os.rename(temp_path, path)
+    except EnvironmentError as err:
+        logger.warning('not saving the compiled geometry: %s', err)
+    return geometry
 
 
 class PixelStrip(object):
     strips = {}
 
-    def __init__(self, bus=0, device=1):
+    def __init__(self, bus=0, device=1, simulated=False, dtype=None):
         # Must set before creating the driver, since the driver can create a child process that needs access
         # to the dictionary that this sets.
         PixelStrip.set(bus, device, self)
 
-        self.count = count = CONFIG['pixels']['count']
-
-        angle_samples = np.array(sorted((x, a) for a, xs in CONFIG['pixels']['angles'].items() for x in xs))
-        # Assume samples are monotonically increasing. Whenever two consecutive samples violate this, add another wind.
-        for i in np.nditer(np.where(np.diff(angle_samples[:, 1]) <= 0)):
-            angle_samples[i + 1:, 1] += 360
-        self.angle = np.interp(np.arange(count), angle_samples[:, 0], angle_samples[:, 1]) % 360
+        geometry = load_geometry()
+        self.count = count = len(geometry['pos'])
+        self.angle = geometry['angle']
+        self.radius = geometry['radius']
+        self.pos = geometry['pos']
+        self.world_pos = geometry['world_pos']
 
-        self.radius = np.linspace(1, 0, num=count, endpoint=False)
+        # for each pixel index, its ring number; and for each ring, its average radius and its range of pixel indices
+        self.pixel_ring = geometry['pixel_ring']
+        self.ring_radius = geometry['ring_radius']
+        self.ring_starts = geometry['ring_starts']
+        self.ring_ends = geometry['ring_ends']
 
-        angles_r = self.angle * pi / 180
-        self.pos = np.c_[
-            0.5 + 0.5 * np.column_stack((self.radius * np.cos(angles_r), self.radius * np.sin(angles_r))),
-            np.linspace(1, 0, num=count, endpoint=False)
-        ]
+        self.spatial_index = SpatialIndex(self.pos, self.angle, self.radius)
 
-        self._initialize_rings()
+        # segments : [(bus, device, start_index, end_index)]
+        segments = CONFIG.get('segments') or [dict(bus=bus, device=device, count=count)]
+        self.segments = []
+        for segment in segments:
+            x0 = self.segments[-1][3] if self.segments else 0
+            self.segments.append((segment['bus'], segment['device'], x0, x0 + segment['count']))
+            PixelStrip.set(segment['bus'], segment['device'], self)
+        if self.segments[-1][3] != count:
+            raise Exception('geometry.yaml: segment counts add up to %d, not %d' % (self.segments[-1][3], count))
 
-        self.driver = apa102.APA102(self.count, bus=bus, device=device)
-        for w in ['clear', 'close', 'show', 'add_hsv', 'add_rgb', 'add_range_hsv', 'add_rgb_array', 'set_hsv']:
+        if len(self.segments) > 1:
+            self.driver = apa102.SegmentedAPA102([(b, d, x1 - x0) for b, d, x0, x1 in self.segments],
+                                                 simulated=simulated, dtype=dtype)
+        else:
+            self.driver = apa102.APA102(self.count, bus=bus, device=device, simulated=simulated, dtype=dtype)
+        for w in ['clear', 'close', 'show', 'add_hsv', 'add_rgb', 'add_range_hsv', 'add_rgb_array', 'set_hsv',
+                  'add_hsv_many', 'add_rgb_many', 'set_rgb_array', 'rgb_array']:
             setattr(self, w, getattr(self.driver, w))
 
-    def _initialize_rings(self):
-        # for each pixel index, its ring number
-        self.pixel_ring = pixel_ring = np.zeros(self.count, int)
-        for index in self.indices_near_angle(180):
-            if index > 0:
-                pixel_ring[index:] += 1
-
-        # compute average radius of each ring
-        ring_count = 1 + np.max(pixel_ring)
-        distances = np.tile(self.radius, (ring_count, 1))  # D[ring_index, pixel_index] = distance
-        ring_indices = np.tile(np.arange(ring_count), (self.count, 1)).transpose()  # R[ring_index, :] = ring_index
-        self.ring_mask = np.equal(np.tile(pixel_ring, (ring_count, 1)), ring_indices)  # S[ri, pi] = True iff pixel pi is in ring ri
-        distances *= self.ring_mask  # D[ring_index] = distances of pixels on the ring; other pixels are 0
-        self.ring_radius = np.sum(distances, axis=1) / np.sum(self.ring_mask, axis=1)
-
     @staticmethod
     def set(bus, device, instance):
         PixelStrip.strips[(bus, device)] = instance
@@ -73,6 +240,10 @@ class PixelStrip(object):
     def get(bus, device):
         return PixelStrip.strips[(bus, device)]
 
+    def segment_start(self, bus, device):
+        """Return the index of the first pixel that is driven by SPI device (bus, device)."""
+        return next(x0 for b, d, x0, _ in self.segments if (b, d) == (bus, device))
+
     def __len__(self):
         return self.count
 
@@ -82,6 +253,21 @@ class PixelStrip(object):
             yield i
 
     def indices_near_angle(self, angle):
-        # FIXME misses the endpoints
-        angles = np.abs((self.angle - angle) % 360)
-        return 1 + (np.diff(np.sign(np.diff(angles))) > 0).nonzero()[0]
+        return indices_near_angle(self.angle, angle)
+
+    def pixels_in_wedge(self, angle0, angle1):
+        """Return the indices of the pixels whose angle is in [angle0, angle1), in degrees. The wedge goes
+        counterclockwise from angle0, and can wrap around 360."""
+        return self.spatial_index.in_wedge(angle0, angle1)
+
+    def pixels_in_radius_band(self, r0, r1):
+        """Return the indices of the pixels whose radius is in [r0, r1)."""
+        return self.spatial_index.in_radius_band(r0, r1)
+
+    def pixels_in_sphere(self, center, r):
+        """Return the indices of the pixels within distance `r` of `center`, an (x, y, z) position."""
+        return self.spatial_index.in_sphere(center, r)
+
+    def nearest_pixels(self, point, k=1):
+        """Return the indices of the `k` pixels nearest to `point`, an (x, y, z) position, nearest first."""
+        return self.spatial_index.nearest(point, k)
@@ -6,17 +6,31 @@ import json
 import logging
 import os
 import random
+import struct
+import sys
 import time
 import types
+import zlib
 import numpy as np
-from messages import get_message
-from publish_message import publish
+import apa102
+from apa102 import PIXEL_DTYPES, is_fixed_point
+from messages import get_messages
+from publish_message import publish, publish_pixels
 from led_geometry import PixelStrip
+from clock_sync import SyncFollower
+from compositor import BLEND_MODES, Compositor
+from frame_cache import FrameCache, cache_key
+from frame_pipeline import FramePipeline
+from frame_profiler import FrameProfiler
+from frame_scheduler import FrameScheduler, monotonic
+from pixel_protocol import PixelFrameDecoder, PixelFrameEncoder
+import benchmark
 import sprites
-from sprites import Scene, EveryNth, Snake, Sparkle, SparkleFade
+from sprites import Scene, EveryNth, Sparkle, SnakeParticles, SparkleParticles
 
 logger = logging.getLogger('lights')
 strip = None  # initialized in `main`
+frame_cache = None  # initialized in `main`, with --frame-cache
 
 
 def capitalize_first_letter(string):
@@ -33,22 +47,51 @@ def lower_first_letter(string):
 def create_scene(scene_or_string):
     """Given a Scene instance, class, or class name, return an instance."""
     obj = scene_or_string
-    if isinstance(scene_or_string, str):
+    if isinstance(scene_or_string, basestring):
         obj = MultiScene.get_scene(scene_or_string)
         obj = obj or getattr(sprites, capitalize_first_letter(scene_or_string), None)
     if isinstance(obj, type):
         obj = obj(strip)
     if not isinstance(obj, Scene):
         raise Exception('Not a scene name: %s' % scene_or_string)
+    if frame_cache and isinstance(scene_or_string, basestring):
+        frames = frame_cache.get(cache_key(scene_or_string, obj, scheduler.fps))
+        if frames:
+            obj = PlaybackMode(obj, frames)
     return obj
 
 
+def scene_name(scene):
+    """Return the name, as `create_scene` accepts it, of the scene that `scene` is showing; or None."""
+    if isinstance(scene, AttractMode):
+        return scene_name(scene.next_child or scene.current_child)
+    if isinstance(scene, PlaybackMode):
+        return scene_name(scene.scene)
+    if isinstance(scene, MultiScene):
+        return scene.__name__
+    if scene is None or isinstance(scene, Mode):
+        return None
+    return lower_first_letter(scene.__class__.__name__)
+
+
 class MultiScene(Scene):
     _named_instances = {}
+    _definitions = {}  # name -> (children, kwargs)
+
+    @classmethod
+    def create(cls, name, children, **kwargs):
+        """Create the scene `name`. `children` is the children, or a function that returns them; with a function,
+        `build` creates each instance of the scene with its own children."""
+        cls._definitions[name] = (children, kwargs)
+        cls._named_instances[name] = cls.build(name)
 
     @classmethod
-    def create(cls, name, children):
-        cls._named_instances[name] = MultiScene(children, name)
+    def build(cls, name):
+        """Return a new instance of the scene `name`."""
+        children, kwargs = cls._definitions[name]
+        if isinstance(children, types.FunctionType):
+            children = children()
+        return MultiScene(children, name, **kwargs)
 
     @classmethod
     def get_scene(cls, name):
@@ -58,11 +101,21 @@ class MultiScene(Scene):
     def get_scene_names(cls):
         return cls._named_instances.keys()
 
-    def __init__(self, children=(), name=None):
+    def __init__(self, children=(), name=None, blend_modes='add', opacities=1.0):
+        """`blend_modes` and `opacities` are each child's blend mode and opacity, or one for every child. The
+        children are composited in order."""
         if not isinstance(children, (types.GeneratorType, collections.Sequence)):
             children = [children]
         self.children = [create_scene(child) for child in children]
         self.__name__ = name or self.children[0].__class__.__name__ if self.children else 'empty'
+        n = len(self.children)
+        self.blend_modes = [blend_modes] * n if isinstance(blend_modes, basestring) else list(blend_modes)
+        self.opacities = [float(opacities)] * n if isinstance(opacities, (int, float)) else map(float, opacities)
+        if len(self.blend_modes) != n or len(self.opacities) != n:
+            raise Exception('%s: expected a blend mode and an opacity for each of %d children' % (self.__name__, n))
+        if not set(self.blend_modes) <= set(BLEND_MODES):
+            raise Exception('%s: unknown blend mode in %s' % (self.__name__, self.blend_modes))
+        self.compositor = Compositor()
 
     def __repr__(self):
         if self.__name__:
@@ -74,45 +127,38 @@ class MultiScene(Scene):
             child.step(strip, t)
 
     def render(self, strip, t):
-        for child in self.children:
-            child.render(strip, t)
+        self.compositor.composite(strip, t, zip(self.children, self.blend_modes, self.opacities))
 
 
 def create_scenes():
     MultiScene.create('empty', [])
 
-    MultiScene.create('nth', [EveryNth(strip, factor=0.1), EveryNth(strip, factor=0.101)])
+    MultiScene.create('nth', lambda: [EveryNth(strip, factor=0.1), EveryNth(strip, factor=0.101)])
 
-    MultiScene.create('sparkle', [Sparkle, SparkleFade])
+    MultiScene.create('sparkle', [Sparkle, SparkleParticles])
 
     # MultiScene.create('gradient', Snake(speed=1, length=len(strip), saturation=0, brightness=1)
 
-    MultiScene.create('gradient', [
+    MultiScene.create('gradient', lambda: sprites.Hoops(strip, [
         sprites.Hoop(strip, offset=0, speed=0.1, hue=0),
         sprites.Hoop(strip, offset=1 / 4.0, speed=0.1, hue=1 / 3.0),
         sprites.Hoop(strip, offset=2 / 4.0, speed=0.1, hue=2 / 3.0),
         sprites.Hoop(strip, offset=3 / 4.0, speed=0.1, saturation=0),
-    ])
+    ]))
 
-    MultiScene.create('hoops', (sprites.Hoop for _ in range(3)))
+    MultiScene.create('hoops', lambda: sprites.Hoops(strip, 3))
 
-    MultiScene.create('drops', (sprites.Droplet for _ in range(10)))
+    MultiScene.create('drops', lambda: sprites.DropletParticles(strip, count=10))
 
     MultiScene.create('game', sprites.InteractiveWalk)
 
-    n = 15
-    children = [Snake(strip, offset=i * len(strip) / float(n), speed=60 * (1 + (0.3 * i)) / 4 * random.choice([1, -1])) for i in range(n)]
-    MultiScene.create('snakes', children)
+    MultiScene.create('snakes', lambda: SnakeParticles(strip, count=15))
 
-    n = 30
-    children = [sprites.RedOrGreenSnake(strip, offset=i * len(strip) / float(n)) for i in range(n)]
-    MultiScene.create('redGreen', children)
+    MultiScene.create('redGreen', lambda: SnakeParticles(strip, count=30, length=20, speed=60, speed_spread=0,
+                                                         reverse=False, hues=(0, .33), brightness=0.3, ramp=False))
 
-    n = 15
-    children = [Snake(strip, offset=i * len(strip) / float(n), speed=60 * (1 + (0.3 * i)) / 4 * random.choice([1, -1])) for i in range(n)]
-    children.append(EveryNth(strip, factor=0.1, v=0.3))
-    children.append(SparkleFade(strip))
-    MultiScene.create('multi', children)
+    MultiScene.create('multi', lambda: [SnakeParticles(strip, count=15), EveryNth(strip, factor=0.1, v=0.3),
+                                        SparkleParticles(strip)])
 
 
 # Modes
@@ -135,6 +181,7 @@ class AttractMode(Mode):
         self.remaining_frames = 0
         self.cross_fade_start = None
         self.next_scene_start = None
+        self.compositor = Compositor()
 
     def next_scene(self):
         # choose a different child than the current one
@@ -164,10 +211,14 @@ class AttractMode(Mode):
                 self.current_child = self.next_child
                 self.next_child = None
 
+        # Each child draws the random numbers that it would draw on its own, so that a lockstep follower that steps
+        # only the new scene draws the same ones.
         if self.current_child:
+            reseed_frame()
             self.current_child.step(strip, t)
 
         if self.next_child:
+            reseed_frame()
             self.next_child.step(strip, t)
 
     def render(self, strip, t):
@@ -176,23 +227,46 @@ class AttractMode(Mode):
             self.current_child.render(strip, t)
 
         if self.next_child:
-            pixels_0 = np.copy(strip.driver.leds)
-            strip.clear()
-            self.next_child.render(strip, t)
-            pixels_1 = strip.driver.leds
-            strip.driver.leds[:] = (1 - self.cross_fade) * pixels_0 + self.cross_fade * pixels_1
+            self.compositor.composite(strip, t, [(self.next_child, 'alpha', self.cross_fade)])
+
+    def encoded_frame(self, t):
+        if self.current_child and not self.next_child:
+            return self.current_child.encoded_frame(t)
+
+
+class PlaybackMode(Mode):
+    """Plays back the pre-rendered frames of `scene`, from a frame cache, in place of rendering and encoding it.
+
+    `scene` is still stepped. It renders the frames that the cached frames can't stand in for, such as cross-fades
+    and frames with scene modifiers.
+    """
+    def __init__(self, scene, frames):
+        self.scene = scene
+        self.frames = frames
+
+    def __str__(self):
+        return str(self.scene)
+
+    def step(self, strip, t):
+        self.scene.step(strip, t)
+
+    def render(self, strip, t):
+        self.scene.render(strip, t)
+
+    def encoded_frame(self, t):
+        return self.frames.frame(t)
 
 
 class SlaveMode(Mode):
-    def __init__(self):
-        self.pixels = None
+    """Displays the pixel frames that a master publishes. `handle_message` decodes them into `decoder`."""
+    def __init__(self, strip):
+        self.decoder = PixelFrameDecoder(len(strip))
 
     def render(self, strip, t):
-        if not self.pixels:
-            return
-        strip.clear()
-        strip.leds = self.pixels
-        self.pixels = None
+        if is_fixed_point(strip.driver.leds):
+            strip.set_rgb_array(0, self.decoder.rgb * (1 / 255.))
+        else:
+            self.decoder.copy_to(strip.driver.leds)
 
 
 def make_modes():
@@ -200,7 +274,7 @@ def make_modes():
 
     attract_mode = AttractMode([
         'multi', 'snakes', 'nth', 'sparkle', 'tunnel', 'hoops', 'drops', 'sweep', 'slices', 'redGreen'])
-    slave_mode = SlaveMode()
+    slave_mode = SlaveMode(strip)
 
 
 # Modifiers
@@ -223,8 +297,7 @@ class SceneModifier(object):
 
 class InvertModifier(SceneModifier):
     def post_render(self, strip, t):
-        pixels = strip.driver.leds
-        pixels[:, :] = (1 - np.clip(pixels[i], 0, 1)) / 2
+        strip.set_rgb_array(0, (1 - np.clip(strip.rgb_array(), 0, 1)) / 2)
 
 
 class ReverseModifier(SceneModifier):
@@ -280,17 +353,15 @@ class OffTransitionModifier(SceneModifier):
         self.s = min(1, s)
 
     def post_render(self, strip, t):
-        pixels = strip.driver.leds
-        pixels *= self.s
         if self.mode in ('dimming', 'brightening'):
             # radius = strip.radius
             radius = strip.ring_radius[strip.pixel_ring]
             values = np.interp(1 - radius + 3 * self.s, [0, 1, 2, 3], [0, 0, 1, 0])
             alpha = np.interp(3 * self.s, [0, 1, 2, 3], [1, 0, 0, 0])
-            pixels *= alpha
-            pixels[:, :] += values[:, np.newaxis]
+            strip.driver.scale(self.s * alpha)
+            strip.add_rgb_array(0, np.broadcast_to(values[:, np.newaxis], (len(values), 3)))
         else:
-            pixels *= 0
+            strip.clear()
 
 
 class SceneManager(Scene):
@@ -335,6 +406,10 @@ class SceneManager(Scene):
         self.current_mode = scene
         self.call_method('next_scene')
 
+    def encoded_frame(self, t):
+        if self.scene and not self.scene_modifiers:
+            return self.scene.encoded_frame(t)
+
     def compute_time(self, t):
         for mod in self.scene_modifiers:
             t = mod.transform_time(t)
@@ -350,15 +425,18 @@ class SceneManager(Scene):
     def render(self, strip, t):
         if self.scene:
             self.scene.render(strip, self.compute_time(t))
+        profiler.mark('render')
         for mod in self.scene_modifiers:
             t = mod.transform_time(t)
             mod.post_render(strip, t)
+            profiler.mark('post_render:' + mod.__class__.__name__)
 
 scene_manager = SceneManager()
 
 
 def change_speed_by(factor):
-    global speed
+    global speed, time_anchor
+    time_anchor = (frame_number, synthetic_time)
     speed *= factor
     if abs(speed - 1.0) < 0.01:
         speed = 1.0
@@ -401,19 +479,43 @@ def handle_action(message):
         print 'unknown message:', action
 
 
-def handle_message():
-    message = get_message()
-    if not message:
-        return False
+def handle_messages():
+    """Handle the messages that arrived since the last frame. Return the number of messages."""
+    messages = get_messages()
+    for message in messages:
+        handle_message(message)
+    return len(messages)
 
-    mtype = message['type']
+
+def handle_message(message):
+    mtype = message.get('type')
     if mtype == 'action':
         handle_action(message)
     elif mtype == 'ping':
         print 'pong'
     elif mtype == 'pixels':
         scene_manager.select_mode(slave_mode)
-        scene_manager.current_mode.pixels = json.loads(str(message['leds']))
+        try:
+            slave_mode.decoder.decode(message['frame'])
+        except (ValueError, struct.error, zlib.error) as err:
+            # keep showing the last frame that decoded
+            logger.warning('invalid pixel frame: %s', err)
+    elif mtype == 'sync':
+        received = message.get('received') or monotonic()
+        if sync_follower and sync_follower.update(message, received):
+            try:
+                scene = create_synced_scene(sync_follower.scene, sync_follower.seed)
+            except Exception as err:
+                logger.warning('sync: %s', err)
+            else:
+                # Step the new scene through the frames that the master has already stepped it through, so that its
+                # state matches the master's. Only the last SYNC_CATCH_UP_FRAMES of them are stepped, so that joining
+                # long after the scene started doesn't stall the output.
+                end = sync_follower.frame_number(received)
+                for frame in xrange(max(sync_follower.start_frame, end - SYNC_CATCH_UP_FRAMES), end):
+                    seed_frame(sync_follower.seed, frame)
+                    scene.step(strip, sync_follower.synthetic_time(frame))
+                scene_manager.select_mode(scene)
     elif mtype == 'gamekey':
         scene_manager.remove_scene_modifier(OffTransitionModifier)
         scene_manager.remove_scene_modifier(StopModifier)
@@ -430,38 +532,154 @@ def handle_message():
             game_mode.child.handle_game_keys(gamekeys)
     else:
         print 'unknown message type:', mtype
-    return True
+
+
+def benchmark_cases():
+    """Yield (name, scene, modifier class or None) for each configuration that `--benchmark` measures."""
+    for name in sorted(MultiScene.get_scene_names()):
+        yield 'scene:' + name, MultiScene.get_scene(name), None
+    for cls in Scene.get_subclasses():
+        # A bare ParticleSystem has no particles to render.
+        if cls is sprites.ParticleSystem:
+            continue
+        if not issubclass(cls, (MultiScene, Mode, SceneManager, sprites.Predicate)):
+            yield 'sprite:' + lower_first_letter(cls.__name__), cls, None
+    for cls in SceneModifier.__subclasses__():
+        yield 'modifier:' + lower_first_letter(cls.__name__), 'multi', cls
+
+
+def run_benchmark(frames):
+    """Render `frames` frames of each benchmark case, and return a report of per-stage frame times."""
+    results = {}
+    for name, scene, modifier_class in benchmark_cases():
+        random.seed(0)
+        np.random.seed(0)
+        scene_manager.scene_modifiers = []
+        scene_manager.select_mode(create_scene(scene))
+        if modifier_class:
+            scene_manager.add_scene_modifier(modifier_class)
+        results[name] = benchmark.time_frames(strip, scene_manager, frames, IDEAL_FRAME_DELTA_T)
+
+    # Start a new cross-fade whenever the previous one finishes, so that every frame is a cross-fade.
+    def cross_fade(t):
+        if not attract_mode.next_child:
+            attract_mode.next_scene()
+    scene_manager.scene_modifiers = []
+    scene_manager.select_mode(attract_mode)
+    results['mode:attractCrossFade'] = benchmark.time_frames(strip, scene_manager, frames, IDEAL_FRAME_DELTA_T,
+                                                             before_frame=cross_fade)
+    return dict(frames=frames, pixels=len(strip), stages=benchmark.STAGES, results=results)
 
 parser = argparse.ArgumentParser(description='Christmas-Tree Lights.')
 parser.add_argument('--debug-messages', dest='debug_messages', action='store_true')
 parser.add_argument('--pygame', dest='pygame', action='store_true')
+parser.add_argument('--record', dest='record', type=str,
+                    help='append every frame that is sent to the simulated SPI devices to a log in this directory')
+parser.add_argument('--record-max-segments', dest='record_max_segments', type=int,
+                    help='with --record, keep only the newest this many 64 MB files of each device (default 16; '
+                         '0 keeps all of them)')
 parser.add_argument('--master', dest='master', action='store_true')
+parser.add_argument('--master-delta', dest='master_delta', action='store_true',
+                    help='with --master, send each frame as its difference from the previous one')
+parser.add_argument('--master-compress', dest='master_compress', action='store_true',
+                    help='with --master, zlib-compress each frame')
+parser.add_argument('--lockstep-master', dest='lockstep_master', action='store_true',
+                    help='broadcast the scene, random seed and animation time, for --lockstep nodes to follow')
+parser.add_argument('--lockstep', dest='lockstep', action='store_true',
+                    help='render the scene and animation time that a --lockstep-master broadcasts')
 parser.add_argument('--no-sync', dest='no_sync', action='store_true')
 parser.add_argument('--scene', dest='scene', type=str)
 parser.add_argument('--scenes', dest='show', action='store_const', const='scenes')
 parser.add_argument('--sprites', dest='show', action='store_const', const='sprites')
 parser.add_argument('--speed', dest='speed', type=float)
+parser.add_argument('--fps', dest='fps', type=float, help='target frame rate (default 60)')
+parser.add_argument('--frame-skip', dest='frame_skip', action='store_true',
+                    help='skip frames that are rendered late, to keep animation time in step with the clock')
 parser.add_argument('--sprite', dest='sprite', type=str)
 parser.add_argument('--warn', dest='warn', action='store_true', help='warn on slow frame rate')
 parser.add_argument('--print-frame-rate', dest='print_frame_rate', action='store_true', help='warn on slow frame rate')
+parser.add_argument('--pipeline', dest='pipeline', action='store_true',
+                    help='encode and send each frame on a background thread, while the next frame renders')
+parser.add_argument('--pipeline-threads', dest='pipeline_threads', type=int, default=1,
+                    help='number of threads that encode the segments of a segmented strip in parallel')
+parser.add_argument('--profile-file', dest='profile_file', type=str,
+                    help='append frame profiles to this file, on SIGUSR1 and every --profile-interval seconds')
+parser.add_argument('--profile-interval', dest='profile_interval', type=float,
+                    help='dump a frame profile this often, in seconds')
+parser.add_argument('--benchmark', dest='benchmark', action='store_true',
+                    help='render every scene, sprite and modifier on the simulator, and print frame times as JSON')
+parser.add_argument('--benchmark-frames', dest='benchmark_frames', type=int, default=300,
+                    help='number of frames to render for each benchmark')
+parser.add_argument('--benchmark-pixel-dtypes', dest='benchmark_pixel_dtypes', action='store_true',
+                    help='print the time that drawing and encoding take with each pixel dtype, as JSON')
+parser.add_argument('--pixel-dtype', dest='pixel_dtype', choices=sorted(PIXEL_DTYPES), default='float64',
+                    help='how pixels are stored: as floats, or as saturating uint16 fixed point')
+parser.add_argument('--frame-cache', dest='frame_cache', type=str,
+                    help='play back the scenes that are pre-rendered in this directory, instead of rendering them')
+parser.add_argument('--frame-cache-size', dest='frame_cache_size', type=int, default=256,
+                    help='remove the least recently used pre-rendered scenes when they take more than this many MB')
+parser.add_argument('--prerender', dest='prerender', type=str, action='append',
+                    help='render this scene to the --frame-cache directory, and exit. Can be repeated.')
+parser.add_argument('--prerender-duration', dest='prerender_duration', type=float, default=60,
+                    help='seconds of each --prerender scene to render; playback loops after this')
 
 
 def main(args):
-    global speed, strip
+    global frame_cache, pipeline, pixel_encoder, speed, strip, sync_follower
 
     # must precede PixelStrip constructor
     if args.pygame:
         os.environ['SPIDEV_PYGAME'] = '1'
+    if args.record:
+        os.environ['SPIDEV_RECORD'] = args.record
+    if args.record_max_segments is not None:
+        os.environ['SPIDEV_RECORD_MAX_SEGMENTS'] = str(args.record_max_segments)
+
+    if args.prerender and not args.frame_cache:
+        parser.error('--prerender requires --frame-cache')
+
+    # the frame rate and frame cache must be set before scenes are created, so that they can be pre-rendered ones
+    if args.fps:
+        scheduler.fps = args.fps
+        profiler.budget = scheduler.frame_delta_t
+    if args.frame_cache and not args.prerender:
+        frame_cache = FrameCache(args.frame_cache, args.frame_cache_size << 20)
+
+    if args.benchmark_pixel_dtypes:
+        print json.dumps(benchmark.time_pixel_dtypes(frames=args.benchmark_frames), indent=2, sort_keys=True)
+        return
+    apa102.pixel_dtype = PIXEL_DTYPES[args.pixel_dtype]
 
     # strip must be initialized before scenes.
     # scenes must be intiialized before modes, and before '--scene' and '--scenes' handling
-    strip = PixelStrip()
+    strip = PixelStrip(simulated=args.benchmark or bool(args.prerender))
     create_scenes()
     make_modes()
+
+    if args.prerender:
+        cache = FrameCache(args.frame_cache, args.frame_cache_size << 20)
+        for name in args.prerender:
+            scene = create_scene(name)
+            path = cache.put(cache_key(name, scene, scheduler.fps), strip, scene, args.prerender_duration,
+                             scheduler.fps)
+            print 'rendered', name, 'to', path
+        return
+
+    if args.benchmark:
+        # Scenes print status messages; keep them out of the report.
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        try:
+            report = run_benchmark(args.benchmark_frames)
+        finally:
+            sys.stdout = stdout
+        print json.dumps(report, indent=2, sort_keys=True)
+        return
+
     scene_manager.select_mode(attract_mode)
 
     if args.show == 'scenes':
-        names = MultiScene.get_scene_names() + list(cls.__name__ for cls in Scene.get_subclasses() if cls not in (Mode,))
+        names = MultiScene.get_scene_names() + list(cls.__name__ for cls in Scene.get_subclasses()
+                                                    if cls not in (Mode, sprites.ParticleSystem))
         names = set(lower_first_letter(name) for name in names)
         print 'scenes:', ', '.join(sorted(list(names)))
         return
@@ -473,75 +691,208 @@ def main(args):
     if args.speed:
         speed = args.speed
 
+    # A lockstep master's followers extrapolate its animation time from its clock, so keep the two in step.
+    scheduler.frame_skip = args.frame_skip or args.lockstep_master
+
+    if args.pipeline:
+        pipeline_profiler = FrameProfiler(budget=scheduler.frame_delta_t, name='pipeline')
+        profiler.subprofilers.append(pipeline_profiler)
+        pipeline = FramePipeline(strip.driver, lambda profiler: present_frame(args, profiler),
+                                 threads=args.pipeline_threads, profiler=pipeline_profiler)
+
     if args.no_sync:
         frame_modifiers.discard('sync')
 
     if args.debug_messages:
         logging.getLogger('messages').setLevel(logging.INFO)
 
+    if args.master:
+        pixel_encoder = PixelFrameEncoder(len(strip), delta=args.master_delta, compress=args.master_compress)
+
+    if args.lockstep:
+        sync_follower = SyncFollower()
+
+    profiler.dump_path = args.profile_file
+    profiler.dump_interval = args.profile_interval or (args.profile_file and 10)
+    profiler.install_signal_handler()
+
     print 'Starting.'
     while True:
+        profiler.start_frame()
         if not args.master:
-            handle_message()
+            handle_messages()
+        profiler.mark('messages')
 
         do_frame(args)
-
-        if args.master:
-            publish('pixels', leds=json.dumps(strip.leds))
+        profiler.end_frame()
 
 last_frame_printed_t = time.time()
-frame_deltas = []  # FIFO of the last 60 frame latencies
 
 frame_modifiers = set(['sync'])
 spin_count = 0
 
 IDEAL_FRAME_DELTA_T = 1.0 / 60
 speed = 1.0
-last_frame_t = time.time()
 synthetic_time = 0
+frame_number = 0  # the number of frame periods since the start; a lockstep follower uses the master's
+time_anchor = (0, 0.)  # (frame number, animation time) from which the animation time advances at `speed`
+scheduler = FrameScheduler(fps=1 / IDEAL_FRAME_DELTA_T)
+skipped_frames = 0  # the scheduler's skipped frame count, as of the last frame
+profiler = FrameProfiler(budget=IDEAL_FRAME_DELTA_T)
+pipeline = None  # initialized in `main`, with --pipeline
+pixel_encoder = None  # initialized in `main`, with --master
+
+SYNC_INTERVAL = 1.0  # seconds between a lockstep master's sync messages
+# A lockstep follower steps a new scene through at most this many of the frames that the master stepped it through
+# before the follower received the scene. A follower that joins later may differ from the master in scene state that
+# lasts longer than this.
+SYNC_CATCH_UP_FRAMES = 120  # two seconds, at 60 frames per second
+sync_follower = None  # initialized in `main`, with --lockstep
+sync_scene = None  # name of the scene that the last sync message announced
+sync_seed = None  # with --lockstep or --lockstep-master, each frame's random numbers are seeded from this
+sync_start = None  # frame number at which the lockstep master started the current scene
+last_sync_t = None  # clock time of the last sync message that this lockstep master published
+last_sync_anchor = None  # the time anchor in the last sync message that this lockstep master published
+
+
+def create_synced_scene(name, seed):
+    """Return a new instance of the scene `name`, created with the random number generators seeded from `seed`, so
+    that every lockstep node creates the same one. It isn't played back from the frame cache, whose frames weren't
+    rendered from `seed`."""
+    random.seed(seed)
+    np.random.seed(seed)
+    if MultiScene.get_scene(name):
+        return MultiScene.build(name)
+    return create_scene(getattr(sprites, capitalize_first_letter(name), name))
+
+
+def replace_shown_scene(scene):
+    """Show `scene` in place of the scene that the scene manager is showing, which may be the attract mode's."""
+    if scene_manager.scene is not attract_mode:
+        scene_manager.select_mode(scene)
+        return
+    shown = attract_mode.next_child or attract_mode.current_child
+    attract_mode.children = attract_mode.children - {shown} | {scene}
+    if attract_mode.next_child:
+        attract_mode.next_child = scene
+    else:
+        attract_mode.current_child = scene
 
 
-def do_frame(options):
-    global last_frame_t, last_frame_printed_t, spin_count, synthetic_time
+def publish_sync(now):
+    """Publish the lockstep master's scene, seed, frame number and animation time, once a second and whenever the
+    scene or the speed changes.
 
-    # Render the current frame
+    A new scene gets a new seed, and is replaced by a new instance that is created from the seed, as the followers
+    create it."""
+    global last_sync_anchor, last_sync_t, sync_scene, sync_seed, sync_start
+    name = scene_name(scene_manager.scene)
+    if name is None:
+        return
+    if name != sync_scene:
+        sync_scene, sync_seed = name, random.SystemRandom().randrange(2 ** 31)
+        sync_start = frame_number
+        replace_shown_scene(create_synced_scene(name, sync_seed))
+    elif now - last_sync_t < SYNC_INTERVAL and time_anchor == last_sync_anchor:
+        return
+    last_sync_t, last_sync_anchor = now, time_anchor
+    publish('sync', scene=name, seed=sync_seed, clock=now, frame=frame_number, fps=scheduler.fps,
+            t_frame=time_anchor[0], t=time_anchor[1], speed=speed, start_frame=sync_start)
+
+
+def frame_time(frame):
+    """Return the animation time of frame number `frame`, at the current speed."""
+    anchor_frame, anchor_t = time_anchor
+    return anchor_t + (frame - anchor_frame) * scheduler.frame_delta_t * speed
+
+
+def seed_frame(seed, frame):
+    """Seed the random number generators from the sync seed and the frame number, so that every lockstep node draws
+    the same random numbers for the same frame."""
+    frame &= 0xffffffff
+    random.seed((seed, frame))
+    np.random.seed([seed, frame])
+
+
+def reseed_frame():
+    """With --lockstep or --lockstep-master, seed the random number generators for the current frame."""
+    if sync_seed is not None:
+        seed_frame(sync_seed, frame_number)
+
+
+def present_frame(options, profiler):
+    """Wait for the encoded frame's deadline, and send it. The SPI worker sends it while the next frame renders."""
+    if scene_manager.current_mode != slave_mode and 'sync' in frame_modifiers:
+        if scheduler.wait() > 0 and options.warn:
+            print 'Frame lagging. Time to optimize.'
+    profiler.mark('sleep')
+    strip.driver.send_frame()
+    profiler.mark('enqueue')
+    scheduler.advance()
+
+
+def do_frame(options):
+    global frame_number, last_frame_printed_t, skipped_frames, spin_count, sync_seed, synthetic_time
+
+    if options.lockstep_master:
+        publish_sync(monotonic())
+    elif sync_follower:
+        master_frame = sync_follower.frame_number(monotonic())
+        if master_frame is not None:
+            frame_number, sync_seed = master_frame, sync_follower.seed
+            synthetic_time = sync_follower.synthetic_time(master_frame)
+    reseed_frame()
+
+    # Render the current frame, unless it's pre-rendered. A master publishes the rendered pixels, so it renders them.
     strip.clear()
     scene_manager.step(strip, synthetic_time)
-    scene_manager.render(strip, synthetic_time)
-    dtime = IDEAL_FRAME_DELTA_T * speed
-    synthetic_time += dtime
+    profiler.mark('step')
+    frame = None if options.master else scene_manager.encoded_frame(synthetic_time)
+    if frame is None:
+        scene_manager.render(strip, synthetic_time)
 
     frame_t = time.time()
-    delta_t = frame_t - last_frame_t
+
+    if options.master:
+        publish_pixels(pixel_encoder.encode(strip.rgb_array(), frame_t))
+        profiler.mark('publish')
 
     # Reprt the running average frame rate
-    frame_deltas.append(delta_t)
-    if len(frame_deltas) > 60:
-        frame_deltas.pop(0)
     if options.print_frame_rate:
         if frame_t - (last_frame_printed_t or frame_t) > 1:
-            print 'fps: %2.1f' % (1 / (sum(frame_deltas) / len(frame_deltas)))
+            print 'fps: %2.1f' % profiler.fps()
             last_frame_printed_t = frame_t
 
-    # Slow down to target frame rate
-    if delta_t < IDEAL_FRAME_DELTA_T:
-        if scene_manager.current_mode != slave_mode and 'sync' in frame_modifiers:
-            time.sleep(IDEAL_FRAME_DELTA_T - delta_t)
-    elif options.warn:
-        print 'Frame lagging. Time to optimize.'
-
-    last_frame_t = time.time()
-    strip.show()
+    if pipeline:
+        pipeline.submit(frame)
+        profiler.mark('submit')
+    else:
+        if frame is None:
+            strip.driver.prepare_frame()
+        else:
+            strip.driver.load_frame(frame)
+        profiler.mark('encode')
+        present_frame(options, profiler)
+
+    # Advance animation time by one frame, plus any that the scheduler skipped.
+    frame_periods = 1 + scheduler.skipped_frames - skipped_frames
+    skipped_frames = scheduler.skipped_frames
+    frame_number += frame_periods
+    synthetic_time = frame_time(frame_number)
+    profiler.dropped_frames = strip.driver.dropped_frames + scheduler.skipped_frames
+    profiler.unchanged_frames = strip.driver.unchanged_frames
 
 try:
     args = parser.parse_args()
     main(args)
 except KeyboardInterrupt:
+    if pipeline:
+        pipeline.close()
     if strip:
         # Fade to black.
         # Improvement: trap this signal, and set a global animation that fades the brightness and then quits.
         for _ in xrange(15):
-            strip.driver.leds[:, 1:] *= .8
+            strip.driver.scale([1, .8, .8])
             strip.show()
             time.sleep(1. / 60)
         strip.clear()
@@ -5,26 +5,57 @@ import socket
 import sys
 import paho.mqtt.client as mqtt
 import mqtt_config
+import pixel_protocol
+from frame_scheduler import monotonic
 
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger('messages')
 
-messages = collections.deque()
+MAX_PENDING_MESSAGES = 256
+
+# Actions that toggle a state. Two of the same in a row cancel out.
+TOGGLE_ACTIONS = frozenset(['toggle', 'stop', 'reverse', 'spin'])
+
+# Decoded messages, waiting for `get_messages`. When this is full, the oldest message is dropped.
+messages = collections.deque(maxlen=MAX_PENDING_MESSAGES)
+dropped_messages = 0  # number of messages that were dropped because `messages` was full
+coalesced_messages = 0  # number of messages that were superseded by later ones
 
 
 def on_connect(client, userdata, flags, rc):
     logger.info('connected result code=%s', str(rc))
     logger.info('subscribe topic=%s', mqtt_config.TOPIC)
-    client.subscribe(mqtt_config.TOPIC, 0)
+    client.subscribe([(mqtt_config.TOPIC, 0), (mqtt_config.PIXELS_TOPIC, 0)])
 
 
 def on_log(client, userdata, level, string):
     logger.info('log %s %s', level, string)
 
 
+# This runs on paho's network thread, so that decoding doesn't take time from rendering.
 def on_message(client, userdata, msg):
-    logger.info('message topic=%s timestamp=%s payload=%s', msg.topic, msg.timestamp, msg.payload)
-    messages.append(msg)
+    global dropped_messages
+    if msg.topic == mqtt_config.PIXELS_TOPIC:
+        logger.debug('message topic=%s timestamp=%s size=%d', msg.topic, msg.timestamp, len(msg.payload))
+        message = dict(type='pixels', frame=msg.payload)
+    else:
+        logger.info('message topic=%s timestamp=%s payload=%s', msg.topic, msg.timestamp, msg.payload)
+        try:
+            message = json.loads(msg.payload)
+        except ValueError as err:
+            logger.warning('invalid message %r: %s', msg.payload, err)
+            return
+        if not isinstance(message, dict):
+            logger.warning('invalid message %r: not an object', msg.payload)
+            return
+        if message.get('type') == 'sync':
+            # A follower estimates the master's clock from when its sync messages arrive, so record that now rather
+            # than when the render loop gets to the message.
+            message['received'] = monotonic()
+    if len(messages) == messages.maxlen:
+        dropped_messages += 1
+        logger.warning('message queue is full; dropped %d messages', dropped_messages)
+    messages.append(message)
 
 
 def on_publish(client, userdata, rc):
@@ -52,17 +83,42 @@ if mqtt_config.hostname:
         print >> sys.stderr, 'Continuing without subscriptions'
 
 
-def get_message():
-    if not messages:
-        return None
-    message = messages.popleft()
-    logger.info('receive %s', message.payload)
-    return json.loads(message.payload)
+def coalesce(pending):
+    """Return the messages in `pending` that aren't superseded by later ones.
+
+    Pixel frames before the last whole frame are superseded by it. (Delta frames after it are kept, since each
+    depends on the one before.) Two of the same toggle action in a row cancel out.
+    """
+    last_keyframe = max([i for i, message in enumerate(pending)
+                         if message.get('type') == 'pixels' and pixel_protocol.is_keyframe(message['frame'])] or [0])
+    result = []
+    for i, message in enumerate(pending):
+        if message.get('type') == 'pixels' and i < last_keyframe:
+            continue
+        if (message.get('type') == 'action' and message.get('action') in TOGGLE_ACTIONS and
+                result and result[-1] == message):
+            result.pop()
+            continue
+        result.append(message)
+    return result
+
+
+def get_messages():
+    """Remove and return all the pending messages, except for those that are superseded by later ones."""
+    global coalesced_messages
+    pending = []
+    while messages:
+        pending.append(messages.popleft())
+    result = coalesce(pending)
+    coalesced_messages += len(pending) - len(result)
+    for message in result:
+        if message.get('type') != 'pixels':
+            logger.info('receive %s', message)
+    return result
 
 if __name__ == '__main__':
     print 'Waiting for messages'
     logger.setLevel(logging.INFO)
     while True:
-        message = get_message()
-        if message:
+        for message in get_messages():
             print message
@@ -5,6 +5,7 @@ MQTT_ENV_VARS = ['MQTT_URL', 'CLOUDMQTT_URL', 'CLOUDAMQP_URL']
 MQTT_URL = next((value for value in (os.environ.get(name) for name in MQTT_ENV_VARS) if value), "mqtt://localhost")
 
 TOPIC = 'xmas-lights'
+PIXELS_TOPIC = TOPIC + '/pixels'  # binary pixel frames; see pixel_protocol.py
 
 hostname = None
 username = None
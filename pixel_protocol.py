@@ -0,0 +1,103 @@
+"""A compact binary format for streaming frames of pixels from a master to its slaves.
+
+A frame is a header followed by a payload. The payload is one byte per color component, in (r, g, b) order, of
+components that are clipped to [0, 1] and scaled to [0, 255] before gamma correction. With FLAG_DELTA, the payload is
+XORed with the previous frame's, so that unchanged pixels are zeros. With FLAG_ZLIB, the payload is zlib-compressed.
+"""
+import struct
+import zlib
+import numpy as np
+
+MAGIC = 'XLPX'
+VERSION = 1
+
+FLAG_DELTA = 1
+FLAG_ZLIB = 2
+
+# magic, version, flags, pixel count, frame number, timestamp
+HEADER = struct.Struct('<4sBBIId')
+
+
+def is_keyframe(data):
+    """Return True if `data` is a whole frame, rather than a delta."""
+    return len(data) >= HEADER.size and not HEADER.unpack_from(data)[2] & FLAG_DELTA
+
+
+class PixelFrameEncoder(object):
+    """Encodes successive frames of a strip.
+
+    Attributes:
+        delta (bool): Encode frames as differences from the previous frame.
+        compress (bool): zlib-compress the payload.
+        keyframe_interval (int): With `delta`, every nth frame is sent whole, so that a slave that missed a frame, or
+            that joined late, can resynchronize.
+    """
+
+    def __init__(self, count, delta=False, compress=False, keyframe_interval=60):
+        self.delta = delta
+        self.compress = compress
+        self.keyframe_interval = keyframe_interval
+        self.frame_number = 0
+        self.rgb = np.zeros((count, 3), np.uint8)
+        self.previous_rgb = np.zeros((count, 3), np.uint8)
+        self._scaled = np.zeros((count, 3))
+
+    def encode(self, leds, timestamp):
+        """Return the encoding of `leds`, an np.ndarray([count, 3]) of floats, as a string."""
+        self.frame_number += 1
+        self.rgb, self.previous_rgb = self.previous_rgb, self.rgb
+        scaled = np.clip(leds, 0.0, 1.0, out=self._scaled)
+        np.multiply(scaled, 255, out=scaled)
+        np.rint(scaled, out=scaled)
+        np.copyto(self.rgb, scaled, casting='unsafe')
+
+        flags = 0
+        payload = self.rgb
+        if self.delta and self.frame_number % self.keyframe_interval != 1:
+            flags |= FLAG_DELTA
+            payload = np.bitwise_xor(self.rgb, self.previous_rgb)
+        payload = payload.tobytes()
+        if self.compress:
+            flags |= FLAG_ZLIB
+            payload = zlib.compress(payload, 1)
+        header = HEADER.pack(MAGIC, VERSION, flags, len(self.rgb), self.frame_number & 0xffffffff, timestamp)
+        return header + payload
+
+
+class PixelFrameDecoder(object):
+    """Decodes the frames that a PixelFrameEncoder produces into `rgb`, an np.ndarray([count, 3]) of uint8.
+
+    A delta frame is skipped unless the previous frame was decoded; decoding resumes at the next whole frame.
+    Pixels that the master has and the slave doesn't are ignored, and vice versa.
+    """
+
+    def __init__(self, count):
+        self.rgb = np.zeros((count, 3), np.uint8)
+        self.frame_number = None
+        self.timestamp = None
+        self.skipped_frames = 0
+
+    def decode(self, data):
+        """Decode the frame `data` into `rgb`. Return True if `rgb` changed."""
+        magic, version, flags, count, frame_number, timestamp = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a pixel frame')
+        payload = buffer(data, HEADER.size)
+        if flags & FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+        pixels = np.frombuffer(payload, np.uint8).reshape(count, 3)
+        n = min(count, len(self.rgb))
+        if flags & FLAG_DELTA:
+            if self.frame_number is None or frame_number != (self.frame_number + 1) & 0xffffffff:
+                self.skipped_frames += 1
+                return False
+            np.bitwise_xor(self.rgb[:n], pixels[:n], out=self.rgb[:n])
+        else:
+            self.rgb[:n] = pixels[:n]
+        self.frame_number = frame_number
+        self.timestamp = timestamp
+        return True
+
+    def copy_to(self, leds):
+        """Copy the decoded frame into `leds`, an np.ndarray([count, 3]) of floats."""
+        np.multiply(self.rgb, 1 / 255., out=leds)
@@ -1,24 +1,142 @@
+import atexit
 import json
 import sys
 import logging
-import paho.mqtt.publish as mqtt_publish
+import threading
+import time
+from Queue import Empty, Full, Queue
+import paho.mqtt.client as mqtt
 import mqtt_config
 
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger('messages')
 
+# Message type -> publish options. Actions are retained, so that a Pi that reconnects picks up the last one.
+# Game keys, pixel frames and sync messages are only useful when they're fresh. Of the pixel frames that are waiting to
+# be sent, only the latest is sent.
+MESSAGE_POLICIES = {
+    'action': dict(qos=1, retain=True),
+    'gamekey': dict(qos=0, retain=False),
+    'pixels': dict(qos=0, retain=False, coalesce=True),
+    'sync': dict(qos=0, retain=False),
+}
+DEFAULT_POLICY = dict(qos=1, retain=True)
+
+
+class Publisher(object):
+    """A persistent MQTT connection, that publishes messages from a bounded queue.
+
+    `enqueue` never blocks: if the queue is full, the message is dropped and counted in `dropped_messages`. A
+    background thread drains everything that's queued each time it wakes, and publishes it. The paho network thread
+    reconnects after the connection drops; messages with QoS > 0 that were published while the connection was down
+    are sent when it comes back.
+    """
+
+    def __init__(self, max_queue=120):
+        self.queue = Queue(max_queue)
+        self.dropped_messages = 0
+        self.unacknowledged = set()  # message ids of published QoS > 0 messages that the broker hasn't acknowledged
+        self.lock = threading.RLock()
+
+        self.client = client = mqtt.Client(client_id='', clean_session=True)
+        if mqtt_config.username:
+            client.username_pw_set(mqtt_config.username, mqtt_config.password)
+        client.on_publish = self._on_publish
+        client.on_disconnect = self._on_disconnect
+        client.reconnect_delay_set(1, 30)
+        client.connect_async(mqtt_config.hostname, mqtt_config.port, 60)
+        client.loop_start()
+
+        self.thread = thread = threading.Thread(name='mqtt-publisher', target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def enqueue(self, topic, payload, qos=1, retain=False, coalesce=False):
+        """Queue a message to be published, and return immediately.
+
+        If `coalesce`, the message is skipped if a later coalescing message to the same topic is sent in the same batch.
+        """
+        try:
+            self.queue.put_nowait((topic, payload, qos, retain, coalesce))
+        except Full:
+            self.dropped_messages += 1
+            logger.warning('publish queue is full; dropped %d messages', self.dropped_messages)
+
+    def _run(self):
+        # Each item is marked done once it's published, so that `flush` waits for the items that this has taken off the
+        # queue as well as for those that are still on it.
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            latest = {item[0]: i for i, item in enumerate(batch) if item and item[4]}
+            for i, item in enumerate(batch):
+                if item is None:
+                    self.queue.task_done()
+                    return
+                topic, payload, qos, retain, coalesce = item
+                if not coalesce or latest[topic] == i:
+                    with self.lock:
+                        rc, mid = self.client.publish(topic, payload, qos=qos, retain=retain)
+                        if qos > 0:
+                            self.unacknowledged.add(mid)
+                    if rc != mqtt.MQTT_ERR_SUCCESS:
+                        logger.info('publish topic=%s result code=%s', topic, rc)
+                self.queue.task_done()
+
+    def _on_publish(self, client, userdata, mid):
+        with self.lock:
+            self.unacknowledged.discard(mid)
+
+    def _on_disconnect(self, client, userdata, rc):
+        logger.info('publisher disconnected result code=%s', rc)
+
+    def flush(self, timeout=5):
+        """Wait up to `timeout` seconds for the queued messages to be published and acknowledged. Return True if they
+        were."""
+        deadline = time.time() + timeout
+        # Queue.join has no timeout, so this polls the count that it waits on.
+        while self.queue.unfinished_tasks or self.unacknowledged:
+            if time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self, timeout=5):
+        """Flush the queue, and disconnect."""
+        self.flush(timeout)
+        self.queue.put(None)
+        self.thread.join(timeout)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+publisher = None
+
+
+def get_publisher():
+    """Return the shared Publisher, creating it on first use. It's flushed when the process exits."""
+    global publisher
+    if not publisher:
+        publisher = Publisher()
+        atexit.register(publisher.flush)
+    return publisher
+
 
 def publish(mtype, **payload):
     payload['type'] = mtype
     logger.info('publish topic=%s payload=%s', mqtt_config.TOPIC, payload)
-    mqtt_publish.single(mqtt_config.TOPIC,
-                        payload=json.dumps(payload),
-                        qos=1,
-                        retain=True,
-                        hostname=mqtt_config.hostname,
-                        auth=mqtt_config.auth,
-                        port=mqtt_config.port,
-                        client_id='')
+    get_publisher().enqueue(mqtt_config.TOPIC, json.dumps(payload), **MESSAGE_POLICIES.get(mtype, DEFAULT_POLICY))
+
+
+def publish_pixels(frame):
+    """Publish a binary pixel frame, from pixel_protocol.PixelFrameEncoder. Frames are neither acknowledged nor
+    retained; a late frame is superseded by the next one."""
+    logger.debug('publish topic=%s size=%d', mqtt_config.PIXELS_TOPIC, len(frame))
+    get_publisher().enqueue(mqtt_config.PIXELS_TOPIC, bytearray(frame), **MESSAGE_POLICIES['pixels'])
 
 
 def repl():
@@ -36,6 +154,9 @@ def main():
     if len(sys.argv) > 1:
         action = sys.argv[1]
         publish('action', action=action)
+        if not get_publisher().flush():
+            print >> sys.stderr, 'Timed out waiting for the broker to acknowledge the message'
+            sys.exit(1)
     else:
         repl()
 
@@ -0,0 +1,101 @@
+"""Geometric queries over the pixels of a strip."""
+import numpy as np
+
+
+class SpatialIndex(object):
+    """Answers queries for the points, such as pixels, that are in a region or near a point.
+
+    The points' angles and radii are kept sorted, so that wedge and radius band queries are binary searches. Their
+    positions are bucketed into a uniform grid of cells, so that sphere and nearest-neighbor queries only look at the
+    points in the cells around the query.
+
+    Parameters
+    ----------
+    pos : np.ndarray([count, 3])
+      Position of each point.
+    angle : np.ndarray([count])
+      Angle of each point around the vertical axis, in degrees.
+    radius : np.ndarray([count])
+      Distance of each point from the vertical axis.
+    points_per_cell : float
+      Average number of points per grid cell, if the points were spread evenly through their bounding box.
+    """
+
+    def __init__(self, pos, angle, radius, points_per_cell=4):
+        self.count = count = len(pos)
+        self.pos = pos
+
+        angle = angle % 360
+        self.angle_order = np.argsort(angle, kind='mergesort')
+        self.sorted_angle = angle[self.angle_order]
+        self.radius_order = np.argsort(radius, kind='mergesort')
+        self.sorted_radius = radius[self.radius_order]
+
+        self.origin = origin = pos.min(axis=0) if count else np.zeros(3)
+        extent = pos.max(axis=0) - origin if count else np.zeros(3)
+        cells_per_axis = max(1, int(round((count / float(points_per_cell)) ** (1 / 3.))))
+        self.cell_size = cell_size = max(np.max(extent) / cells_per_axis, 1e-9)
+        self.grid_shape = grid_shape = (extent // cell_size).astype(int) + 1
+        cell_ids = np.ravel_multi_index(self._cell_coordinates(pos).T, grid_shape)
+        # the points in cell i are cell_order[cell_starts[i]:cell_starts[i + 1]]
+        self.cell_order = np.argsort(cell_ids, kind='mergesort')
+        self.cell_starts = np.searchsorted(cell_ids[self.cell_order], np.arange(np.prod(grid_shape) + 1))
+
+    def _cell_coordinates(self, pos):
+        cells = np.floor_divide(pos - self.origin, self.cell_size).astype(int)
+        return np.clip(cells, 0, self.grid_shape - 1, out=cells)
+
+    def in_wedge(self, angle0, angle1):
+        """Return the indices of the points whose angle is in [angle0, angle1), counterclockwise from angle0 and
+        wrapping around 360, in order of angle."""
+        if angle1 - angle0 >= 360:
+            return self.angle_order
+        a0 = angle0 % 360
+        a1 = a0 + (angle1 - angle0) % 360
+        i0 = np.searchsorted(self.sorted_angle, a0)
+        if a1 <= 360:
+            return self.angle_order[i0:np.searchsorted(self.sorted_angle, a1)]
+        return np.concatenate((self.angle_order[i0:], self.angle_order[:np.searchsorted(self.sorted_angle, a1 - 360)]))
+
+    def in_radius_band(self, r0, r1):
+        """Return the indices of the points whose radius is in [r0, r1), in order of radius."""
+        return self.radius_order[np.searchsorted(self.sorted_radius, r0):np.searchsorted(self.sorted_radius, r1)]
+
+    def in_box(self, lo, hi):
+        """Return the indices of the points in the grid cells that overlap the box from `lo` to `hi`. This is a
+        superset of the points in the box."""
+        lo, hi = np.asarray(lo, float), np.asarray(hi, float)
+        if not self.count or np.any(hi < self.origin) or np.any(lo > self.origin + self.cell_size * self.grid_shape):
+            return np.zeros(0, int)
+        c0, c1 = self._cell_coordinates(lo), self._cell_coordinates(hi)
+        # Cells that differ only in their last coordinate are consecutive, so each (x, y) column is one range.
+        xs, ys = np.meshgrid(np.arange(c0[0], c1[0] + 1), np.arange(c0[1], c1[1] + 1), indexing='ij')
+        starts = self.cell_starts[np.ravel_multi_index((xs.ravel(), ys.ravel(), c0[2]), self.grid_shape)]
+        ends = self.cell_starts[np.ravel_multi_index((xs.ravel(), ys.ravel(), c1[2]), self.grid_shape) + 1]
+        return np.concatenate([self.cell_order[start:end] for start, end in zip(starts, ends)])
+
+    def in_sphere(self, center, r):
+        """Return the indices of the points within distance `r` of `center`."""
+        center = np.asarray(center, float)
+        candidates = self.in_box(center - r, center + r)
+        offsets = self.pos[candidates] - center
+        return candidates[np.einsum('ij,ij->i', offsets, offsets) <= r * r]
+
+    def nearest(self, point, k=1):
+        """Return the indices of the `k` points nearest to `point`, nearest first."""
+        point = np.asarray(point, float)
+        k = min(k, self.count)
+        if not k:
+            return np.zeros(0, int)
+        r = self.cell_size
+        while True:
+            candidates = self.in_box(point - r, point + r)
+            if len(candidates) >= k:
+                offsets = self.pos[candidates] - point
+                distances = np.einsum('ij,ij->i', offsets, offsets)
+                nearest = np.argpartition(distances, k - 1)[:k]
+                # Points outside the box are further than r. If the kth-nearest candidate is within r, it's the
+                # kth-nearest point.
+                if distances[nearest].max() <= r * r or len(candidates) == self.count:
+                    return candidates[nearest[np.argsort(distances[nearest], kind='mergesort')]]
+            r *= 2
@@ -1,8 +1,11 @@
+import ctypes
 import logging
 import os
 import signal
-from multiprocessing import Process, Queue
+from multiprocessing import Condition, Process, Queue
+from multiprocessing.sharedctypes import RawArray, RawValue
 import cPickle as pickle
+import numpy as np
 
 # TODO DRY apa102.py
 try:
@@ -39,6 +42,153 @@ class SpiMaster(object):
         self.p.join()
 
 
+class FrameRing(object):
+    """A ring of fixed-size frame slots in shared memory, written by one process and sent by another.
+
+    Each published frame is numbered. The writer publishes a slot by recording its number in `slot_seq`, and in
+    `published_seq`; the reader takes the most recently published slot, and sets `taken_seq` to its number. A frame
+    that is published before the reader took its predecessor supersedes it.
+
+    Attributes:
+        frame_size (int): Size of a frame, in bytes.
+        slots (int): Number of frame slots. Three are enough for the writer to always find a free slot.
+    """
+
+    def __init__(self, frame_size, slots=3):
+        self.frame_size = frame_size
+        self.slots = slots
+        self.buffer = RawArray(ctypes.c_uint8, frame_size * slots)
+        self.slot_seq = RawArray(ctypes.c_long, slots)
+        self.published_slot = RawValue(ctypes.c_int, -1)
+        self.published_seq = RawValue(ctypes.c_long, 0)
+        self.reading_slot = RawValue(ctypes.c_int, -1)
+        self.taken_seq = RawValue(ctypes.c_long, 0)
+
+    def slot(self, index):
+        """Return slot `index`, as a uint8 array that shares its memory."""
+        return np.frombuffer(self.buffer, np.uint8, self.frame_size, index * self.frame_size)
+
+    def has_new_frame(self):
+        return self.taken_seq.value != self.published_seq.value
+
+
+class FrameGroup(object):
+    """The FrameRings of one or more SPI workers, whose workers take and send each frame together.
+
+    The rings share `condition`. A writer that publishes to several rings within one `with group.condition` block
+    publishes them as a unit. Each worker waits at a barrier until the others have sent their previous frame, and the
+    last one to arrive takes the latest frame from every ring, so that the segments of a strip stay in sync.
+    """
+
+    def __init__(self, frame_sizes, slots=3):
+        self.rings = [FrameRing(frame_size, slots) for frame_size in frame_sizes]
+        self.condition = Condition()
+        self.arrived = RawValue(ctypes.c_int, 0)
+        self.generation = RawValue(ctypes.c_long, 0)
+        self.closed = RawValue(ctypes.c_bool, False)
+
+    def take(self, index):
+        """Wait for the next frame, and return the slot that ring `index` should send; or None if the group is
+        closed."""
+        condition = self.condition
+        with condition:
+            self.arrived.value += 1
+            if self.arrived.value == len(self.rings):
+                while not self.closed.value and not all(ring.has_new_frame() for ring in self.rings):
+                    condition.wait()
+                for ring in self.rings:
+                    ring.reading_slot.value = ring.published_slot.value
+                    ring.taken_seq.value = ring.published_seq.value
+                self.arrived.value = 0
+                self.generation.value += 1
+                condition.notify_all()
+            else:
+                generation = self.generation.value
+                while not self.closed.value and self.generation.value == generation:
+                    condition.wait()
+            if self.closed.value:
+                return None
+            return self.rings[index].reading_slot.value
+
+    def release(self, index):
+        """Record that ring `index`'s worker has finished sending the slot that it took."""
+        with self.condition:
+            self.rings[index].reading_slot.value = -1
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed.value = True
+            self.condition.notify_all()
+
+
+class SharedMemorySpiMaster(SpiMaster):
+    """An SpiMaster that passes frames through a FrameRing instead of pickling them through a queue.
+
+    The client writes each frame in place into the buffer returned by `frame_buffer`, and calls `commit` to send it.
+    Several masters can share a FrameGroup, in which case each is passed the group and the index of its ring.
+
+    Attributes:
+        drop_stale (bool): If true, a committed frame replaces one that the worker hasn't started sending, and the
+            `dropped_frames` counter is incremented. If false, `frame_buffer` waits for the worker to take the
+            previous frame. Either way, `close` waits for the worker to take the last frame.
+    """
+
+    def __init__(self, frame_size=None, slots=3, drop_stale=True, group=None, index=0, **kwargs):
+        self.frame_no = 0
+        self.dropped_frames = 0
+        self.drop_stale = drop_stale
+        self.group = group = group or FrameGroup([frame_size], slots)
+        self.index = index
+        self.ring = ring = group.rings[index]
+        self.buffers = [ring.slot(i) for i in xrange(ring.slots)]
+        self.write_slot = None
+        self.p = p = Process(name='spi_slave', target=SpiWorker.run_ring, args=(group, index, kwargs))
+        p.daemon = True
+        p.start()
+
+    def frame_buffer(self):
+        """Return a uint8 array to write the next frame into."""
+        ring = self.ring
+        condition = self.group.condition
+        with condition:
+            if not self.drop_stale:
+                while ring.has_new_frame():
+                    condition.wait()
+            busy = (ring.published_slot.value, ring.reading_slot.value)
+            self.write_slot = next(i for i in xrange(ring.slots) if i not in busy)
+        return self.buffers[self.write_slot]
+
+    def commit(self):
+        """Publish the frame that was written into the buffer returned by `frame_buffer`."""
+        ring = self.ring
+        self.frame_no += 1
+        with self.group.condition:
+            if ring.has_new_frame():
+                self.dropped_frames += 1
+                mlogger.info('drop frame #%d', ring.published_seq.value)
+            ring.slot_seq[self.write_slot] = self.frame_no
+            ring.published_slot.value = self.write_slot
+            ring.published_seq.value = self.frame_no
+            self.group.condition.notify_all()
+        mlogger.info('publish frame #%d', self.frame_no)
+        self.write_slot = None
+
+    def xfer2(self, data):
+        data = np.frombuffer(data, np.uint8)
+        self.frame_buffer()[:len(data)] = data
+        self.commit()
+
+    def close(self):
+        mlogger.info('close SPI master')
+        # let the worker take the last frame, so that it's sent before the worker exits
+        with self.group.condition:
+            while self.ring.has_new_frame() and self.p.is_alive():
+                self.group.condition.wait(0.1)
+        self.group.close()
+        self.p.join()
+
+
 class SpiWorker(object):
     @staticmethod
     def run(q, initargs):
@@ -56,6 +206,23 @@ class SpiWorker(object):
             data = pickle.loads(item)
             instance.xfer2(data)
 
+    @staticmethod
+    def run_ring(group, index, initargs):
+        wlogger.info('creating shared-memory SPI worker')
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        instance = SpiWorker(None, **initargs)
+        ring = group.rings[index]
+        buffers = [ring.slot(i) for i in xrange(ring.slots)]
+        while True:
+            slot = group.take(index)
+            if slot is None:
+                break
+            wlogger.info('take frame #%d from slot %d', ring.slot_seq[slot], slot)
+            instance.xfer2(buffers[slot].tobytes())
+            group.release(index)
+        wlogger.info('close SPI worker')
+        instance.close()
+
     def __init__(self, queue, bus=0, device=1, max_speed_hz=0):
         self.frame_no = 0
         self.queue = queue
@@ -0,0 +1,271 @@
+#!/usr/bin/python
+"""Records the frames that are sent to the simulated SPI devices, and replays them.
+
+A log is a series of segment files, for each SPI device. A segment file is a header, followed by records. Each record
+is a header with the time that the frame was transferred, and the device and size of the frame, followed by the frame.
+When a segment file grows past a size limit, the writer starts the next one.
+
+Usage:
+    SPIDEV_RECORD=DIR python lights.py      # or python lights.py --record DIR
+    python spi_recording.py info DIR
+    python spi_recording.py replay DIR [--speed 4] [--pygame]
+    python spi_recording.py compare DIR DIR
+"""
+import argparse
+import glob
+import heapq
+import itertools
+import mmap
+import os
+import struct
+import sys
+import time
+from frame_scheduler import monotonic
+
+MAGIC = 'XLSP'
+VERSION = 1
+SUFFIX = '.spilog'
+
+# magic, version
+FILE_HEADER = struct.Struct('<4sBxxx')
+
+# timestamp, bus, device, frame size
+RECORD_HEADER = struct.Struct('<dBBxxI')
+
+
+class FrameLogWriter(object):
+    """Appends frames to the segment files of one device's log, in `directory`.
+
+    Attributes:
+        segment_bytes (int): A segment file that grows larger than this is closed, and the next one started.
+        max_segments (int): If set, the oldest of the device's segment files are removed to keep this many.
+    """
+
+    def __init__(self, directory, bus, device, segment_bytes=64 << 20, max_segments=None):
+        self.directory = directory
+        self.bus = bus
+        self.device = device
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.prefix = os.path.join(directory, 'spidev%d.%d-' % (bus, device))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        existing = self.segment_paths()
+        self.segment_number = int(existing[-1][len(self.prefix):-len(SUFFIX)]) + 1 if existing else 0
+        self.file = None
+
+    def segment_paths(self):
+        return sorted(glob.glob(self.prefix + '[0-9]*' + SUFFIX))
+
+    def _start_segment(self):
+        if self.file:
+            self.file.close()
+        path = '%s%06d%s' % (self.prefix, self.segment_number, SUFFIX)
+        self.segment_number += 1
+        self.file = open(path, 'wb')
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        if self.max_segments:
+            for old_path in self.segment_paths()[:-self.max_segments]:
+                os.remove(old_path)
+
+    def write(self, data, timestamp=None):
+        """Append the frame `data`, a string or buffer, that was transferred at `timestamp`."""
+        if self.file is None or self.file.tell() >= self.segment_bytes:
+            self._start_segment()
+        self.file.write(RECORD_HEADER.pack(time.time() if timestamp is None else timestamp,
+                                           self.bus, self.device, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def read_segment(path, use_mmap=False):
+    """Yield (timestamp, bus, device, data) for each record in the segment file `path`.
+
+    With `use_mmap`, the file is memory-mapped and `data` is a buffer into it, which is only valid until the next
+    record is read. A record that was cut short, for example because the recording process was killed, ends the
+    segment.
+    """
+    with open(path, 'rb') as f:
+        if use_mmap:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            contents = f.read()
+    try:
+        if len(contents) < FILE_HEADER.size or FILE_HEADER.unpack_from(contents) != (MAGIC, VERSION):
+            raise ValueError('%s: not an SPI log file' % path)
+        offset = FILE_HEADER.size
+        while offset + RECORD_HEADER.size <= len(contents):
+            timestamp, bus, device, size = RECORD_HEADER.unpack_from(contents, offset)
+            offset += RECORD_HEADER.size
+            if offset + size > len(contents):
+                break
+            yield timestamp, bus, device, buffer(contents, offset, size)
+            offset += size
+    finally:
+        if use_mmap:
+            contents.close()
+
+
+def device_segment_paths(directory):
+    """Return a list of the segment file paths of each device's log in `directory`, in order."""
+    devices = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*' + SUFFIX))):
+        devices.setdefault(os.path.basename(path).rsplit('-', 1)[0], []).append(path)
+    return [paths for _, paths in sorted(devices.items())]
+
+
+def read_device(paths, use_mmap=False):
+    """Yield (timestamp, bus, device, data) for each record in the segment files `paths`, of one device's log."""
+    for path in paths:
+        for record in read_segment(path, use_mmap):
+            yield record
+
+
+def read_log(directory, use_mmap=False):
+    """Yield (timestamp, bus, device, data) for each record of each device's log in `directory`, in time order."""
+    return heapq.merge(*[read_device(paths, use_mmap) for paths in device_segment_paths(directory)])
+
+
+def read_frames(directory, use_mmap=False):
+    """Yield (timestamp, {(bus, device): data}) for each frame of a strip whose devices' logs are in `directory`.
+
+    The devices of a segmented strip send each frame together, but their logs can start at different frames, since
+    the writers remove old segment files separately. The records of each device that precede its record nearest to
+    the start of the latest-starting log are skipped, and the rest are paired up in order. The frames end with the
+    shortest log.
+    """
+    logs = device_segment_paths(directory)
+    first_timestamps = [next((record[0] for record in read_device(paths, True)), None) for paths in logs]
+    logs = [paths for paths, timestamp in zip(logs, first_timestamps) if timestamp is not None]
+    if not logs:
+        return
+    start = max(timestamp for timestamp in first_timestamps if timestamp is not None)
+
+    def leading_records(paths):
+        count, nearest = 0, None
+        for i, (timestamp, _, _, _) in enumerate(read_device(paths, True)):
+            if nearest is not None and abs(timestamp - start) >= nearest:
+                break
+            count, nearest = i, abs(timestamp - start)
+        return count
+
+    devices = [itertools.islice(read_device(paths, use_mmap), leading_records(paths), None) for paths in logs]
+    for records in itertools.izip(*devices):
+        yield min(record[0] for record in records), {(bus, device): data for _, bus, device, data in records}
+
+
+def segment_drivers(strip):
+    """Return a dict of (bus, device) -> the APA102 that drives that device's pixels of `strip`."""
+    driver = strip.driver
+    if not hasattr(driver, 'segments'):
+        return {(bus, device): driver for bus, device, _, _ in strip.segments}
+    return {(bus, device): segment for (bus, device, _, _), segment in zip(strip.segments, driver.segments)}
+
+
+def replay(frames, strip, speed=1.0, max_gap=1.0):
+    """Send the frames in `frames`, from `read_frames`, through the driver of `strip`. Return the number of frames that
+    were sent.
+
+    Frames are paced at `speed` times the rate at which they were recorded, or sent as fast as possible if `speed` is
+    0. A pause of more than `max_gap` seconds in the recording, such as between two runs, is shortened to `max_gap`.
+    A frame that doesn't have a frame of the right size for each of the strip's devices is skipped; the devices'
+    frames are sent together, so that a segmented strip's workers never wait for a device that has no frame. No frame
+    is dropped, even if the SPI workers fall behind.
+    """
+    drivers = segment_drivers(strip)
+    for driver in drivers.values():
+        if hasattr(driver.spi, 'drop_stale'):
+            driver.spi.drop_stale = False
+    sent = 0
+    recorded_elapsed = 0.
+    previous_timestamp = None
+    start = monotonic()
+    for timestamp, device_frames in frames:
+        if not all(len(device_frames.get(key, '')) == 4 + 4 * driver.count for key, driver in drivers.items()):
+            continue
+        if speed:
+            if previous_timestamp is not None:
+                recorded_elapsed += min(max(timestamp - previous_timestamp, 0), max_gap)
+            delay = start + recorded_elapsed / speed - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        previous_timestamp = timestamp
+        for key, driver in drivers.items():
+            driver.load_frame(device_frames[key])
+        strip.driver.send_frame(force=True)
+        sent += 1
+    return sent
+
+
+def compare(records_a, records_b):
+    """Compare two logs frame by frame. Return (frame count, number of frames that differ, index of the first frame
+    that differs or None). Timestamps are ignored; a frame that is in only one log differs."""
+    frames = differences = 0
+    first_difference = None
+    sentinel = (None, None, None, None)
+    records_a, records_b = iter(records_a), iter(records_b)
+    while True:
+        _, bus_a, device_a, data_a = next(records_a, sentinel)
+        _, bus_b, device_b, data_b = next(records_b, sentinel)
+        if data_a is None and data_b is None:
+            return frames, differences, first_difference
+        if (bus_a, device_a) != (bus_b, device_b) or data_a is None or data_b is None or data_a[:] != data_b[:]:
+            differences += 1
+            if first_difference is None:
+                first_difference = frames
+        frames += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect, replay, and compare SPI frame logs.')
+    subparsers = parser.add_subparsers(dest='command')
+    info_parser = subparsers.add_parser('info', help='print the number, rate, and time span of the frames in a log')
+    info_parser.add_argument('log')
+    replay_parser = subparsers.add_parser('replay', help='send the frames in a log through the strip')
+    replay_parser.add_argument('log')
+    replay_parser.add_argument('--speed', type=float, default=1.0,
+                               help='multiple of the recorded speed; 0 sends the frames as fast as possible')
+    replay_parser.add_argument('--pygame', action='store_true')
+    compare_parser = subparsers.add_parser('compare', help='compare the frames in two logs byte for byte')
+    compare_parser.add_argument('log')
+    compare_parser.add_argument('other_log')
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        count, first, last = 0, None, None
+        for timestamp, _, _, _ in read_log(args.log, use_mmap=True):
+            count += 1
+            first = first or timestamp
+            last = timestamp
+        duration = (last - first) if count else 0
+        rate = count / duration if duration else 0
+        print '%d frames over %.1f seconds (%.1f frames/second)' % (count, duration, rate)
+    elif args.command == 'replay':
+        # must precede PixelStrip constructor
+        if args.pygame:
+            os.environ['SPIDEV_PYGAME'] = '1'
+        from led_geometry import PixelStrip
+        strip = PixelStrip()
+        try:
+            start = monotonic()
+            sent = replay(read_frames(args.log, use_mmap=True), strip, speed=args.speed)
+            elapsed = monotonic() - start
+            rate = sent / elapsed if elapsed else 0
+            print 'sent %d frames in %.1f seconds (%.1f frames/second)' % (sent, elapsed, rate)
+        finally:
+            strip.close()
+    elif args.command == 'compare':
+        frames, differences, first_difference = compare(read_log(args.log), read_log(args.other_log))
+        print '%d frames; %d differ' % (frames, differences)
+        if differences:
+            print 'first difference at frame', first_difference
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
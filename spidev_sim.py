@@ -2,9 +2,20 @@ import os
 import re
 import sys
 import numpy as np
+from spi_recording import FrameLogWriter
 
 gamma = 2.5
 
+# Each device's recording keeps at most this many segment files, unless SPIDEV_RECORD_MAX_SEGMENTS overrides it; 0
+# keeps all of them.
+RECORD_MAX_SEGMENTS = 16
+
+# The pygame screen, and the 32-bit canvas surface that is copied to it. Every device draws into the same canvas, so
+# that the segments of a strip are shown together. The display is closed when the last device that uses it is closed.
+screen = None
+canvas = None
+open_displays = 0
+
 
 class SPI(object):
     def __init__(self, devpath, mode, max_speed_hz):
@@ -26,18 +37,37 @@ class SpiDev(object):
         self.bus = bus
         self.device = device
 
+        # With SPIDEV_RECORD set to a directory, every frame is appended to a log there, with or without pygame.
+        self.recorder = None
+        if os.environ.get('SPIDEV_RECORD'):
+            max_segments = int(os.environ.get('SPIDEV_RECORD_MAX_SEGMENTS', RECORD_MAX_SEGMENTS))
+            self.recorder = FrameLogWriter(os.environ['SPIDEV_RECORD'], bus, device, max_segments=max_segments or None)
+
         self.pygame = None
         if not os.environ.get('SPIDEV_PYGAME'):
             return
 
+        global screen, canvas, open_displays
         import pygame
         self.pygame = pygame
-        pygame.init()
         self.width = 600
-        self.screen = pygame.display.set_mode((self.width, self.width))
-        self.screen.fill((0, 0, 0))
+        self.led_size = 5
+        if not open_displays:
+            pygame.init()
+            screen = pygame.display.set_mode((self.width, self.width))
+            screen.fill((0, 0, 0))
+            canvas = pygame.Surface((self.width, self.width), 0, 32)
+        open_displays += 1
+        self.screen = screen
+        self.canvas = canvas
         self.ix = 0  # next pixel index
 
+        # color_table[brightness, c, component] = the mapped screen intensity of component c, at a five-bit brightness
+        intensities = (255 * np.outer(np.arange(32) / 31., np.arange(256) / 255.) ** (1 / gamma)).astype(np.uint32)
+        shifts = np.array(self.canvas.get_shifts()[:3], np.uint32)
+        self.color_table = np.left_shift(intensities[:, np.newaxis, :], shifts[np.newaxis, :, np.newaxis])
+        self.disc_offsets = None  # computed by `_layout`, on the first transfer
+
     @property
     def strip(self):
         # FIXME This is called after `open`, because the led_geometry->apa102->spidev_sim->led_geometry
@@ -47,11 +77,44 @@ class SpiDev(object):
             self.__strip = PixelStrip.get(self.bus, self.device)
         return self.__strip
 
+    def _layout(self):
+        """Compute where this device's pixels are drawn, from the strip geometry. Screen pixel (x, y) is at offset
+        y * width + x.
+
+        disc_offsets[i] are the offsets of the screen pixels in the disc that draws pixel i. Where discs overlap, the
+        later pixel is drawn on top, so screen pixel covered[j] shows pixel covered_by[j].
+        """
+        width, led_size = self.width, self.led_size
+        strip = self.strip
+        x0 = strip.segment_start(self.bus, self.device)
+        x1 = next(x1 for b, d, _, x1 in strip.segments if (b, d) == (self.bus, self.device))
+        centers = np.round(strip.pos[x0:x1, :2] * (width - led_size)).astype(int)
+        dx, dy = np.mgrid[-led_size:led_size + 1, -led_size:led_size + 1]
+        disc = dx ** 2 + dy ** 2 <= led_size ** 2
+        xs = np.clip(centers[:, :1] + dx[disc], 0, width - 1)
+        ys = np.clip(centers[:, 1:] + dy[disc], 0, width - 1)
+        self.disc_offsets = ys * width + xs
+
+        owner = np.full(width * width, -1, int)
+        owner[self.disc_offsets.ravel()] = np.repeat(np.arange(len(centers)), disc.sum())
+        self.covered = np.flatnonzero(owner >= 0)
+        self.covered_by = owner[self.covered]
+
     def close(self):
+        global screen, canvas, open_displays
+        if self.recorder:
+            self.recorder.close()
         if self.pygame:
-            self.pygame.quit()
+            open_displays -= 1
+            if not open_displays:
+                screen = canvas = None
+                self.pygame.quit()
+            self.pygame = None
 
     def xfer2(self, data):
+        if self.recorder:
+            self.recorder.write(np.asarray(data, np.uint8).tobytes())
+
         pygame = self.pygame
         if not pygame:
             return
@@ -60,29 +123,34 @@ class SpiDev(object):
             if event.type == pygame.QUIT:
                 sys.exit()
 
-        inverse_gamma = 1 / gamma
-        led_size = 5
-        width = self.width
-
-        frames = np.array(data).reshape(-1, 4)
-        for pixels in np.split(frames, np.where(np.all(frames == 0, axis=1))[0]):
-            if not pixels.size:
-                continue
-
-            if np.all(pixels[0] == 0):
-                self.ix = 0
-                pixels = np.delete(pixels, 0, axis=0)
-
-            rows = pixels.shape[0]
-            indices = self.ix + np.arange(rows)
-            self.ix += rows
-
-            pos = np.round(self.strip.pos[indices][:, :-1] * (width - led_size)).astype(int)
-
-            assert np.all(np.bitwise_and(pixels[:, 0], 0xe0) == 0xe0)
-            rgbf = np.fliplr(pixels[:, 1:]) / 255. * (np.bitwise_and(0x1f, pixels[:, 0]) / 31)[:, np.newaxis]
-            rgbi = (rgbf ** inverse_gamma * 255.).astype(int)
-            for i in xrange(0, rows):
-                pygame.draw.circle(self.screen, rgbi[i], pos[i], led_size)
-
+        # A row of zeros is a frame header, which resets the pixel index.
+        rows = np.asarray(data, np.uint8).reshape(-1, 4)
+        if not len(rows):
+            return
+        is_header = ~np.any(rows, axis=1)
+        row_numbers = np.arange(len(rows))
+        frame_starts = np.maximum.accumulate(np.where(is_header, row_numbers + 1, 0))
+        indices = row_numbers - frame_starts
+        indices[~np.maximum.accumulate(is_header)] += self.ix
+        pixels, indices = rows[~is_header], indices[~is_header]
+        self.ix = 0 if is_header[-1] else indices[-1] + 1
+
+        if self.disc_offsets is None:
+            self._layout()
+        disc_offsets = self.disc_offsets
+        in_strip = indices < len(disc_offsets)
+        pixels, indices = pixels[in_strip], indices[in_strip]
+        assert np.all(np.bitwise_and(pixels[:, 0], 0xe0) == 0xe0)
+        components = self.color_table[np.bitwise_and(pixels[:, :1], 0x1f), np.arange(3), pixels[:, 3:0:-1]]
+        colors = np.bitwise_or.reduce(components, axis=1)
+
+        # Later pixels are drawn over earlier ones, as when each is drawn in turn. The canvas is locked while `image`,
+        # which shares its memory, exists.
+        image = pygame.surfarray.pixels2d(self.canvas).T.reshape(-1)
+        if len(indices) == len(disc_offsets) and indices[0] == 0 and indices[-1] == len(indices) - 1:
+            image[self.covered] = colors[self.covered_by]
+        else:
+            image[disc_offsets[indices]] = colors[:, np.newaxis]
+        del image
+        self.screen.blit(self.canvas, (0, 0))
         pygame.display.update()
@@ -1,6 +1,6 @@
 import random
-from colorsys import hsv_to_rgb
 import numpy as np
+from color import hsv_to_rgb_array, hue_palette, palette_index
 
 
 class Scene(object):
@@ -27,6 +27,10 @@ class Scene(object):
     def render(self, strip, t):
         raise NotImplementedError
 
+    # Return a frame that was encoded in advance for time t, to send in place of rendering one; or None.
+    def encoded_frame(self, t):
+        return None
+
 
 class Sprite(Scene):
     def __init__(self, strip, offset=0, speed=60):
@@ -42,7 +46,7 @@ class Sprite(Scene):
 
     def render(self, strip, t):
         if hasattr(self, 'pixels'):
-            strip.add_rgb_array(int(self.offset), np.array(self.pixels))
+            strip.add_rgb_array(int(self.offset), self.pixels)
 
 
 class Snake(Sprite):
@@ -53,19 +57,13 @@ class Snake(Sprite):
         self.saturation = float(saturation)
         self.brightness = float(brightness)
         self.pixels = np.zeros((length, 3))
+        self.palette = hue_palette(self.saturation)
+        self.ramp = (np.arange(0, length) / float(length))[:, np.newaxis]
 
     def step(self, strip, t):
         super(self.__class__, self).step(strip, t)
-        brightness = self.brightness
-        length = self.length
-
-        pixels = self.pixels
         h = 0.5 * (self.hue_offset + self.offset) % len(strip) / len(strip)
-        pixels[:, :] = hsv_to_rgb(h, self.saturation, 1)
-        brightness = np.arange(0, length) / float(length)
-        pixels[:, 0] *= brightness
-        pixels[:, 1] *= brightness
-        pixels[:, 2] *= brightness
+        np.multiply(self.ramp, self.palette[palette_index(h)], out=self.pixels)
 
         # f, x = math.modf(offset + length)
         # if f > 0:
@@ -75,7 +73,7 @@ class Snake(Sprite):
 class Slices(Scene):
     def render(self, strip, t):
         speeds = np.array([.4, .5, .6])
-        strip.driver.leds[:, :] = (strip.pos + t * speeds) % 1
+        strip.set_rgb_array(0, (strip.pos + t * speeds) % 1)
 
 
 class EveryNth(Scene):
@@ -85,13 +83,30 @@ class EveryNth(Scene):
         self.speed = 60.0 * speed
         self.offset = float(offset)
         self.v = v
+        self.spacings = self.spacing * np.arange(self.num)
+        self.rgb = hsv_to_rgb_array((0, 0, v))
 
     def render(self, strip, t):
         offset = self.offset + self.speed * t
-        r, g, b = hsv_to_rgb(0, 0, self.v)
-        for i in xrange(self.num):
-            x = (offset + self.spacing * i) % len(strip)
-            strip.add_rgb(x, r, g, b)
+        strip.add_rgb_many((offset + self.spacings) % len(strip), self.rgb)
+
+
+def hoop_ring_values(ring_radius, radii, ring_count=3):
+    """Return the brightness of each ring for a hoop at each of `radii`, as an np.ndarray([hoop count, ring count]).
+
+    A hoop lights the `ring_count` rings that are closest to it, with the radius wrapping around 1, and leaves the
+    others dark.
+    """
+    radii = np.asarray(radii, dtype=ring_radius.dtype)[:, np.newaxis]
+    distance = (ring_radius - radii) % 1
+    distance = np.minimum(np.abs(distance), np.abs(1 - distance)) ** 2
+    closest = np.argpartition(distance, min(ring_count, len(ring_radius)) - 1, axis=1)[:, :ring_count]
+    hoops = np.arange(len(radii))[:, np.newaxis]
+    closest_distance = distance[hoops, closest]
+    values = np.zeros_like(distance)
+    d_sum = np.sum(closest_distance, axis=1, keepdims=True)
+    values[hoops, closest] = (1.0 - closest_distance / d_sum) ** 5
+    return values
 
 
 class Hoop(Scene):
@@ -102,31 +117,47 @@ class Hoop(Scene):
         self.saturation = saturation
         self.speed = speed or random.randrange(1, 3) * 0.1
         self.reverse = random.random() < 0.25
+        self.rgb = hsv_to_rgb_array((self.hue, self.saturation, 1))
 
-        # ring_ends : [(start_index, 1 + end_index)]
-        ring_count = np.max(strip.pixel_ring) + 1
-        ring_pixel_indices = np.ma.masked_array(np.tile(np.arange(len(strip)), (ring_count, 1)), mask=np.equal(strip.ring_mask, False))
-        self.ring_ends = zip(np.min(ring_pixel_indices, axis=1), 1 + np.max(ring_pixel_indices, axis=1))
+    def radius(self, t):
+        r0 = (self.offset + self.speed * t) % 1.0
+        return 1.0 - r0 if self.reverse else r0
 
     def render(self, strip, t):
-        r0 = (self.offset + self.speed * t) % 1.0
-        if self.reverse:
-            r0 = 1.0 - r0
+        values = hoop_ring_values(strip.ring_radius, [self.radius(t)])[0]
+        strip.add_rgb_array(0, (values[:, np.newaxis] * self.rgb)[strip.pixel_ring])
+
 
-        distance = (strip.ring_radius - r0) % 1
-        distance = np.minimum(np.abs(distance), np.abs(1 - distance)) ** 2
-        closest_ring = np.argsort(distance)[:3]
-        d_sum = np.sum(distance[closest_ring])
-        value = (1.0 - distance / d_sum) ** 5
-        h = self.hue
-        s = self.saturation
-        for v, x0, x1 in ((value[i],) + self.ring_ends[i] for i in closest_ring):
-            strip.add_range_hsv(x0, x1, h, s, v)
+class Hoops(Scene):
+    """Hoops that are rendered together.
+
+    Each ring's color is the sum of the hoops' colors, weighted by how brightly each hoop lights the ring. The ring
+    colors are gathered to the pixels through `strip.pixel_ring`, so that the pixels are visited once, however many
+    hoops and rings there are.
+
+    Attributes:
+        children ([Hoop]): The hoops.
+    """
+
+    def __init__(self, strip, hoops=3):
+        if isinstance(hoops, int):
+            hoops = [Hoop(strip) for _ in range(hoops)]
+        self.children = list(hoops)
+        self.offsets = np.array([hoop.offset for hoop in self.children], float)
+        self.speeds = np.array([hoop.speed for hoop in self.children], float)
+        self.reverse = np.array([hoop.reverse for hoop in self.children], bool)
+        self.rgbs = np.array([hoop.rgb for hoop in self.children])
+
+    def render(self, strip, t):
+        radii = (self.offsets + self.speeds * t) % 1.0
+        values = hoop_ring_values(strip.ring_radius, np.where(self.reverse, 1.0 - radii, radii))
+        strip.add_rgb_array(0, values.T.dot(self.rgbs)[strip.pixel_ring])
 
 
 class Sparkle(Scene):
     def __init__(self, strip):
-        self.indices = []
+        self.indices = np.zeros(0, int)
+        self.hsv = np.zeros((0, 3))
         self.last_time = 0
 
     def step(self, strip, t):
@@ -138,8 +169,7 @@ class Sparkle(Scene):
         self.hsv = np.column_stack((np.random.random(n), np.tile(0.3, n), np.random.random(n)))
 
     def render(self, strip, t):
-        for ii, i in enumerate(self.indices):
-            strip.add_hsv(i, *self.hsv[ii])
+        strip.add_hsv_many(self.indices, self.hsv)
 
 
 class SparkleFade(Scene):
@@ -157,25 +187,21 @@ class SparkleFade(Scene):
         self.lifetime = float(lifetime)
         self.max_v = float(max_v)
 
-        self.active = {}  # Map from index -> activation time
+        # Sparkle i is at pixel indices[i], and was activated at activation_times[i].
+        self.indices = np.zeros(count, int)
+        self.activation_times = np.tile(-np.inf, count)
 
     def step(self, strip, t):
-        expired = [ii for ii, activation_time in self.active.items() if t - activation_time > self.lifetime]
-        for i in expired:
-            del self.active[i]
-
-        for i in xrange(self.count - len(self.active)):
-            ix = random.randint(0, len(self.strip) - 1)
-            self.active[ix] = t
-            if ix > 10:
-                self.active[ix] -= random.random() * self.lifetime * 0.5
+        expired = np.flatnonzero(t - self.activation_times > self.lifetime)
+        n = len(expired)
+        indices = np.random.randint(0, len(self.strip), n)
+        self.indices[expired] = indices
+        self.activation_times[expired] = t - (indices > 10) * np.random.random(n) * self.lifetime * 0.5
 
     def render(self, strip, t):
-        lifetime = self.lifetime
-        for i, activation_time in self.active.iteritems():
-            v = self.max_v * (1 - ((t - activation_time) / lifetime))
-            if v > 0:
-                strip.add_hsv(i, 0., 0., v)
+        v = self.max_v * (1 - ((t - self.activation_times) / self.lifetime))
+        visible = v > 0
+        strip.add_rgb_many(self.indices[visible], v[visible, np.newaxis])
 
 
 class Sweep(Scene):
@@ -188,11 +214,11 @@ class Sweep(Scene):
         angle = self.a_speed * t
         value = (strip.angle - angle) % 360 / 360
         value = value ** self.exponent
-        strip.driver.leds[:, :] = value[:, np.newaxis]
+        rgbs = np.repeat(value[:, np.newaxis], 3, axis=1)
 
         i = int((self.r_speed * t) % 3)
-        value = (strip.radius - self.r_speed * t) % 1
-        strip.driver.leds[:, i] = value
+        rgbs[:, i] = (strip.radius - self.r_speed * t) % 1
+        strip.set_rgb_array(0, rgbs)
 
 
 class Tunnel(Scene):
@@ -201,16 +227,18 @@ class Tunnel(Scene):
         self.back = (self.front_angle + 180.0) % 360
         self.band_angle = 0.0
         self.band_width = 15.0
+        self.palette = hue_palette(1.0, 0.2)
 
     def render(self, strip, t):
         band_angle = (self.band_angle + 4 * 60 * t) % 180
         front_angle = (self.front_angle + 1 * 60 * t) % 360
         half_width = self.band_width / 2.0
-        r, g, b = hsv_to_rgb(band_angle / 90., 1.0, 0.2)
-        angles = np.abs(strip.angle - front_angle)
-        angles = np.minimum(angles % 360, -angles % 360)
-        for i in np.where(abs(angles - band_angle) < half_width)[0]:
-            strip.add_rgb(i, r, g, b)
+        rgb = self.palette[palette_index(band_angle / 90.)]
+        # the pixels whose angular distance from the front is within half_width of band_angle, on either side
+        a0, a1 = front_angle + band_angle, front_angle - band_angle
+        indices = np.union1d(strip.pixels_in_wedge(a0 - half_width, a0 + half_width),
+                             strip.pixels_in_wedge(a1 - half_width, a1 + half_width))
+        strip.add_rgb_many(indices, rgb)
 
 
 class Droplet(Scene):
@@ -225,7 +253,7 @@ class Droplet(Scene):
         self.angle = random.uniform(0, 360)
         self.offset = random.uniform(-.3, -.1)
         self.hue = random.random()
-        self.indices = np.array(list(strip.indices_near_angle(self.angle)))
+        self.indices = strip.indices_near_angle(self.angle)
 
     def render(self, strip, t):
         offset = self.offset + (t - self.start_time) * self.speed
@@ -233,18 +261,25 @@ class Droplet(Scene):
         closest_pixel = np.argsort(distance)[:2]
         value = (1 - distance) ** 2
         value /= np.sum(value[closest_pixel])
-        for i in closest_pixel:
-            strip.add_hsv(self.indices[i], self.hue, 0., value[i])
+        hsvs = np.zeros((len(closest_pixel), 3))
+        hsvs[:, 0] = self.hue
+        hsvs[:, 2] = value[closest_pixel]
+        strip.add_hsv_many(self.indices[closest_pixel], hsvs)
 
 
 class Predicate(Scene):
+    """Lights the pixels that satisfy `predicate`.
+
+    `predicate` is called with an array of pixel indices, and returns a boolean array of the same length.
+    """
+
     def __init__(self, strip, predicate):
         self.f = predicate
+        self.indices = np.arange(len(strip))
+        self.rgb = hsv_to_rgb_array((0, 0, 0.04))
 
     def render(self, strip, t):
-        for i in xrange(len(strip)):
-            if self.f(i):
-                strip.add_hsv(i, 0, 0, 0.04)
+        strip.add_rgb_many(self.indices[self.f(self.indices)], self.rgb)
 
 
 class InteractiveWalk(Scene):
@@ -252,6 +287,7 @@ class InteractiveWalk(Scene):
         self.strip = strip
         self.pos = 124
         self.radius = 3
+        self.rgb = hsv_to_rgb_array((0.3, 0.4, 0.2))
 
     def handle_game_keys(self, keys):
         if keys['left']:
@@ -261,9 +297,8 @@ class InteractiveWalk(Scene):
         self.pos = self.pos % len(self.strip)
 
     def render(self, strip, t):
-        for i in xrange(self.pos - self.radius, self.pos + self.radius):
-            i = i % len(strip)
-            strip.add_hsv(i, 0.3, 0.4, 0.2)
+        indices = np.arange(self.pos - self.radius, self.pos + self.radius) % len(strip)
+        strip.add_rgb_many(indices, self.rgb)
 
 
 class RedOrGreenSnake(Sprite):
@@ -273,5 +308,190 @@ class RedOrGreenSnake(Sprite):
         self.length = 20
         self.hue = random.choice([0, .33])
 
-        r, g, b = hsv_to_rgb(self.hue, 1, self.brightness)
-        self.pixels = [[r, g, b]] * self.length
+        self.pixels = np.tile(hsv_to_rgb_array((self.hue, 1, self.brightness)), (self.length, 1))
+
+
+class ParticleSystem(Scene):
+    """Many sprites that are stepped and rendered together.
+
+    Each property of a particle is an element of an array with one element per slot. Stepping or rendering any
+    number of particles is then a few array operations, instead of a method call per sprite.
+
+    Particle i lights `length[i]` pixels, starting at `position[i]`. It moves `speed[i]` pixels per second. On the
+    strip, it wraps around at the ends. On a track, it moves through the track's pixels in order. Its color has hue
+    `hue[i]`, shifted by `hue_per_pixel` for each pixel of its position, and brightness `value[i]`. It expires
+    `lifetime[i]` seconds after `birth[i]`.
+
+    Slots are reused, so spawning and expiring particles allocates nothing. `spawn` starts particles in free slots,
+    and an expired particle frees its slot. A subclass that overrides `respawn` refills the freed slots on each step.
+
+    Attributes:
+        capacity (int): Number of particle slots.
+        max_length (int): Maximum particle length, in pixels.
+        saturation (float): Saturation of every particle's color.
+        hue_per_pixel (float): Change in a particle's hue for each pixel of its position.
+        ramp (bool): If true, a particle brightens from 0 at its tail towards `value` at its head, as a Snake does.
+        fade (bool): If true, a particle dims from `value` to 0 over its lifetime, as a SparkleFade sparkle does.
+        antialias (bool): If true, a particle at a fractional position is split between the pixels on either side.
+        tracks (np.ndarray([track count, max track length + 1])): The pixel indices of each track, in the order that
+            particles move through them, padded with -1.
+    """
+
+    PROPERTIES = ('position', 'speed', 'hue', 'value', 'length', 'track', 'birth', 'lifetime')
+
+    def __init__(self, strip, capacity=1000, max_length=1, saturation=1.0, hue_per_pixel=0.0, ramp=False, fade=False,
+                 antialias=False, tracks=()):
+        self.capacity = int(capacity)
+        self.max_length = int(max_length)
+        self.saturation = float(saturation)
+        self.hue_per_pixel = float(hue_per_pixel)
+        self.ramp = ramp
+        self.fade = fade
+        self.antialias = antialias
+        self.palette = hue_palette(self.saturation)
+        self.last_time = None
+
+        # The last column is always -1, so that an index of -1 or past the end of a track is off the track.
+        self.track_lengths = np.array([len(track) for track in tracks], int)
+        self.tracks = np.tile(-1, (len(tracks), max(self.track_lengths) + 1 if len(tracks) else 1))
+        for i, track in enumerate(tracks):
+            self.tracks[i, :len(track)] = track
+
+        # weights[length, step] is the brightness, relative to its value, of the pixel `step` pixels from the tail of
+        # a particle `length` pixels long. It is 0 past the particle's head.
+        self.steps = np.arange(self.max_length)
+        lengths = np.arange(self.max_length + 1)[:, np.newaxis]
+        self.weights = (self.steps < lengths) * (self.steps / np.maximum(lengths, 1.0) if ramp else 1.0)
+
+        self.alive = np.zeros(self.capacity, bool)
+        self.position = np.zeros(self.capacity)
+        self.speed = np.zeros(self.capacity)
+        self.hue = np.zeros(self.capacity)
+        self.value = np.zeros(self.capacity)
+        self.length = np.zeros(self.capacity, int)
+        self.track = np.zeros(self.capacity, int)
+        self.birth = np.zeros(self.capacity)
+        self.lifetime = np.zeros(self.capacity)
+
+    def free_slots(self, count=None):
+        """Return the indices of up to `count` free slots, or of all of them."""
+        return np.flatnonzero(~self.alive)[:count]
+
+    def spawn(self, t, slots, **properties):
+        """Start a particle, born at `t`, in each of `slots`.
+
+        Each of `properties` is one of PROPERTIES, with a value for every particle or an array of values. The other
+        properties take their defaults: a full-brightness particle of hue 0 and length 1, that stands still at 0 on the
+        strip, and never expires.
+        """
+        unknown = set(properties) - set(self.PROPERTIES)
+        if unknown:
+            raise ValueError('unknown particle properties: %s' % ', '.join(sorted(unknown)))
+        defaults = dict(position=0, speed=0, hue=0, value=1, length=1, track=-1, birth=t, lifetime=np.inf)
+        defaults.update(properties)
+        for name, value in defaults.items():
+            getattr(self, name)[slots] = value
+        self.length[slots] = np.clip(self.length[slots], 0, self.max_length)
+        self.alive[slots] = True
+
+    def respawn(self, strip, t, slots):
+        """Called on each step with the free `slots`, for a subclass to start particles in."""
+        pass
+
+    def step(self, strip, t):
+        if self.last_time is not None:
+            self.position += self.speed * (t - self.last_time)
+            np.copyto(self.position, self.position % len(strip), where=self.track < 0)
+        self.last_time = t
+        self.alive &= t - self.birth < self.lifetime
+        slots = self.free_slots()
+        if len(slots):
+            self.respawn(strip, t, slots)
+
+    def render(self, strip, t):
+        live = np.flatnonzero(self.alive)
+        if not len(live):
+            return
+        position = self.position[live]
+        brightness = self.value[live]
+        if self.fade:
+            brightness = brightness * np.clip(1 - (t - self.birth[live]) / self.lifetime[live], 0, 1)
+        hues = self.hue[live]
+        if self.hue_per_pixel:
+            hues = hues + self.hue_per_pixel * position
+        colors = self.palette[palette_index(hues)] * brightness[:, np.newaxis]
+
+        # Each particle covers max_length pixels from its tail, and the weights darken the ones past its head.
+        xs = position[:, np.newaxis] + self.steps
+        rgbs = colors[:, np.newaxis, :] * self.weights[self.length[live]][:, :, np.newaxis]
+        if self.antialias:
+            whole = np.floor(xs)
+            f = (xs - whole)[:, :, np.newaxis]
+            xs = np.concatenate((whole, whole + 1), axis=1)
+            rgbs = np.concatenate((rgbs * (1 - f), rgbs * f), axis=1)
+        xs = np.floor(xs).astype(int)
+        if len(self.tracks):
+            track = self.track[live][:, np.newaxis]
+            on_track = self.tracks[track, np.clip(xs, -1, self.tracks.shape[1] - 1)]
+            xs = np.where(track < 0, xs % len(strip), on_track)
+        else:
+            xs %= len(strip)
+        strip.add_rgb_many(xs.ravel(), rgbs.reshape(-1, 3))
+
+
+class SnakeParticles(ParticleSystem):
+    """Snakes spaced evenly along the strip, as a particle system.
+
+    Snake i moves at `speed * (1 + speed_spread * i)` pixels per second, in a random direction if `reverse` is true.
+    Without `hues`, a snake's hue changes with its position, as a Snake's does. With `hues`, each snake has one of
+    them, at random.
+    """
+
+    def __init__(self, strip, count=15, length=10, speed=15, speed_spread=0.3, reverse=True, hues=None,
+                 brightness=1.0, ramp=True):
+        super(SnakeParticles, self).__init__(strip, capacity=count, max_length=length, ramp=ramp,
+                                             hue_per_pixel=0 if hues else 0.5 / len(strip))
+        i = np.arange(count)
+        offsets = i * len(strip) / float(count)
+        directions = [random.choice([1, -1]) if reverse else 1 for _ in i]
+        self.spawn(0, i, position=offsets, speed=speed * (1 + speed_spread * i) * directions, length=length,
+                   value=brightness, hue=[random.choice(hues) for _ in i] if hues else offsets * self.hue_per_pixel)
+
+
+class SparkleParticles(ParticleSystem):
+    """Sparkles that fade over time, as a particle system. See SparkleFade."""
+
+    def __init__(self, strip, count=50, lifetime=.8, max_v=0.5):
+        super(SparkleParticles, self).__init__(strip, capacity=count, saturation=0, fade=True)
+        self.max_lifetime = float(lifetime)
+        self.max_v = float(max_v)
+
+    def respawn(self, strip, t, slots):
+        n = len(slots)
+        positions = np.random.randint(0, len(strip), n)
+        self.spawn(t, slots, position=positions, value=self.max_v, lifetime=self.max_lifetime,
+                   birth=t - (positions > 10) * np.random.random(n) * self.max_lifetime * 0.5)
+
+
+class DropletParticles(ParticleSystem):
+    """Droplets that move outwards along the pixels near an angle, as a particle system. See Droplet.
+
+    A droplet's track is one of `angle_count` evenly spaced angles. It starts 0.1 to 0.3 of the track length before
+    the start of the track, and is respawned when it is 1.2 track lengths past the start.
+    """
+
+    def __init__(self, strip, count=10, speed=0.3, angle_count=72):
+        tracks = []
+        for angle in np.arange(angle_count) * 360. / angle_count:
+            indices = strip.indices_near_angle(angle)
+            tracks.append(indices[np.argsort(strip.radius[indices], kind='mergesort')])
+        super(DropletParticles, self).__init__(strip, capacity=count, saturation=0, antialias=True, tracks=tracks)
+        self.track_speed = float(speed)
+
+    def respawn(self, strip, t, slots):
+        n = len(slots)
+        track = np.random.randint(0, len(self.tracks), n)
+        offsets = np.random.uniform(-.3, -.1, n)
+        lengths = self.track_lengths[track]
+        self.spawn(t, slots, track=track, position=offsets * lengths, speed=self.track_speed * lengths,
+                   lifetime=(1.2 - offsets) / self.track_speed)
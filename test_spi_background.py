@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import unittest
+from spi_background import SharedMemorySpiMaster
+from spi_recording import read_log
+
+
+class SharedMemorySpiMasterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # the worker process inherits the environment, and records the frames that it sends
+        os.environ['SPIDEV_RECORD'] = self.directory
+
+    def tearDown(self):
+        del os.environ['SPIDEV_RECORD']
+        shutil.rmtree(self.directory)
+
+    def sent_frames(self):
+        return [data[:] for _, _, _, data in read_log(self.directory)]
+
+    def check_close_sends_last_frame(self, drop_stale):
+        master = SharedMemorySpiMaster(frame_size=8, drop_stale=drop_stale)
+        for i in xrange(1, 16):
+            master.xfer2(chr(i) * 8)
+        master.xfer2('\0' * 8)
+        master.close()
+        frames = self.sent_frames()
+        self.assertEqual(frames[-1:], ['\0' * 8])
+        if not drop_stale:
+            self.assertEqual(len(frames), 16)
+
+    def test_close_sends_last_frame(self):
+        self.check_close_sends_last_frame(drop_stale=True)
+
+    def test_close_sends_last_frame_without_dropping(self):
+        self.check_close_sends_last_frame(drop_stale=False)
+
+
+if __name__ == '__main__':
+    unittest.main()